@@ -14,13 +14,15 @@ from product import (
     Product, ProductCode, Template,
     ProductSaleChannelListing
 )
-from sale import Sale
+from sale import Sale, AmazonOrderQueue
 from party import Party, Address
 from country import Subdivision
+from feed import AmazonFeed, AmazonFeedMessage
 from shipment import (
-    ShipmentOut, StockLocation, ShipmentInternal,
+    StockMove, ShipmentOut, StockLocation, ShipmentInternal,
     InboundShipmentProducts, InboundShipmentCreateStart,
-    InboundShipmentCreate
+    InboundShipmentCreate, AmazonFulfillment, InboundShipmentRequest,
+    InboundShipmentRequestLine
 )
 
 
@@ -40,11 +42,18 @@ def register():
         Address,
         Subdivision,
         ProductSaleChannelListing,
+        StockMove,
         ShipmentOut,
         StockLocation,
         ShipmentInternal,
         InboundShipmentProducts,
         InboundShipmentCreateStart,
+        AmazonFeed,
+        AmazonFeedMessage,
+        AmazonFulfillment,
+        InboundShipmentRequest,
+        InboundShipmentRequestLine,
+        AmazonOrderQueue,
         module='amazon_mws', type_='model'
     )
     Pool.register(
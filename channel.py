@@ -3,20 +3,26 @@
     channle.py
 
 """
+import csv
 import logging
 from datetime import datetime
+from StringIO import StringIO
 from mws import mws
-from lxml import etree
 from lxml.builder import E
+from collections import defaultdict
 from dateutil.relativedelta import relativedelta
 
 from trytond.model import ModelView, fields
+from trytond.cache import Cache
 from trytond.wizard import Wizard, StateView, Button
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.pool import Pool, PoolMeta
+from trytond.exceptions import UserError
 from boto.mws import connection
 
+from feed import FeedWriter, FlatFileWriter, FEED_STATES
+
 __metaclass__ = PoolMeta
 
 __all__ = [
@@ -61,6 +67,98 @@ class SaleChannel:
         domain=[('type', '=', 'warehouse')],
         states=AMAZON_MWS_STATES, depends=['source']
     )
+    amazon_feed_max_messages = fields.Integer(
+        "Max Messages per Feed", states=AMAZON_MWS_STATES, depends=['source'],
+        help="Feeds with more messages are split into several feeds"
+    )
+    amazon_feed_max_size = fields.Integer(
+        "Max Feed Size (MB)", states=AMAZON_MWS_STATES, depends=['source'],
+        help="Feeds larger than this are split into several feeds"
+    )
+    amazon_fulfillment_batch_size = fields.Integer(
+        "Fulfillment Batch Size", states=AMAZON_MWS_STATES,
+        depends=['source'], help="Queued order fulfillments are sent as "
+        "soon as this many are waiting, else on the next scheduled run"
+    )
+    amazon_export_mode = fields.Selection([
+        ('xml', 'XML Feeds (Price and Inventory)'),
+        ('flat_file', 'Flat File (Price and Quantity)'),
+    ], "Export Mode", states=AMAZON_MWS_STATES, depends=['source'],
+        help="XML sends prices and inventory in separate feeds, flat file "
+        "sends both in a single tab delimited feed"
+    )
+    amazon_fba_inventory_report_request = fields.Char(
+        "FBA Inventory Report Request ID", readonly=True, states={
+            'invisible': ~(Eval('source') == 'amazon_mws')
+        }, depends=['source']
+    )
+    last_amazon_inbound_shipment_sync_time = fields.DateTime(
+        "Last Inbound Shipment Sync Time", states={
+            'invisible': ~(Eval('source') == 'amazon_mws')
+        }, depends=['source']
+    )
+    amazon_listing_report_request = fields.Char(
+        "Listing Report Request ID", readonly=True, states={
+            'invisible': ~(Eval('source') == 'amazon_mws')
+        }, depends=['source']
+    )
+
+    # FBA warehouse id => id of the amazon channel
+    _fba_warehouse_cache = Cache(
+        'sale.channel.fba_warehouse', context=False
+    )
+
+    @classmethod
+    def create(cls, vlist):
+        cls._fba_warehouse_cache.clear()
+        return super(SaleChannel, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._fba_warehouse_cache.clear()
+        super(SaleChannel, cls).write(*args)
+
+    @classmethod
+    def delete(cls, channels):
+        cls._fba_warehouse_cache.clear()
+        super(SaleChannel, cls).delete(channels)
+
+    @classmethod
+    def get_fba_warehouse_channels(cls):
+        """
+        Return the map of the FBA warehouses to the amazon channel they
+        belong to. The map is cached and cleared when channels change.
+
+        :returns: Dictionary of warehouse id => channel id
+        """
+        result = cls._fba_warehouse_cache.get('map')
+        if result is not None:
+            return result
+
+        result = {}
+        for values in cls.search_read([
+                ('source', '=', 'amazon_mws'),
+                ('fba_warehouse', '!=', None)],
+                fields_names=['fba_warehouse']):
+            result.setdefault(values['fba_warehouse'], values['id'])
+        cls._fba_warehouse_cache.set('map', result)
+        return result
+
+    @staticmethod
+    def default_amazon_feed_max_messages():
+        return 30000
+
+    @staticmethod
+    def default_amazon_feed_max_size():
+        return 10
+
+    @staticmethod
+    def default_amazon_fulfillment_batch_size():
+        return 500
+
+    @staticmethod
+    def default_amazon_export_mode():
+        return 'xml'
 
     @classmethod
     def get_source(cls):
@@ -91,7 +189,11 @@ class SaleChannel:
             "missing_product_code": (
                 'Product "%(product)s" misses Product Code'
             ),
-            'invalid_channel': 'Channel does not belong to Amazon.'
+            'invalid_channel': 'Channel does not belong to Amazon.',
+            'report_not_generated': (
+                'Amazon could not generate the report "%(report_type)s". '
+                'Status: %(status)s'
+            ),
         })
 
     def validate_amazon_channel(self):
@@ -149,6 +251,195 @@ class SaleChannel:
             account_id=self.amazon_merchant_id,
         )
 
+    @staticmethod
+    def iter_amazon_inbound_shipments(mws_connection_api, **kwargs):
+        """
+        Yield the shipment data of the inbound shipments listed by amazon
+        for the filters given, following the next tokens.
+
+        :param mws_connection_api: boto MWS connection of the channel
+        :param kwargs: Filters of ListInboundShipments
+        """
+        result = mws_connection_api.list_inbound_shipments(
+            **kwargs
+        ).ListInboundShipmentsResult
+        while True:
+            for shipment_data in result.ShipmentData:
+                yield shipment_data
+            if not getattr(result, 'NextToken', None):
+                break
+            result = mws_connection_api.list_inbound_shipments_by_next_token(
+                NextToken=result.NextToken
+            ).ListInboundShipmentsByNextTokenResult
+
+    @staticmethod
+    def iter_amazon_inbound_shipment_items(mws_connection_api, **kwargs):
+        """
+        Yield the item data of the inbound shipment items listed by amazon
+        for the filters given, following the next tokens.
+
+        :param mws_connection_api: boto MWS connection of the channel
+        :param kwargs: Filters of ListInboundShipmentItems
+        """
+        result = mws_connection_api.list_inbound_shipment_items(
+            **kwargs
+        ).ListInboundShipmentItemsResult
+        while True:
+            for item_data in result.ItemData:
+                yield item_data
+            if not getattr(result, 'NextToken', None):
+                break
+            result = mws_connection_api.\
+                list_inbound_shipment_items_by_next_token(
+                    NextToken=result.NextToken
+                ).ListInboundShipmentItemsByNextTokenResult
+
+    def get_amazon_inbound_shipment_statuses(self, shipment_ids):
+        """
+        Return the status of the inbound shipments of this channel, using
+        one request for every 50 shipments, the limit of amazon.
+
+        :param shipment_ids: List of MWS inbound shipment IDs
+        :returns: Dictionary of shipment id => shipment status
+        """
+        mws_connection_api = self.get_mws_boto_connection_api()
+
+        statuses = {}
+        for shipment_ids_batch in batch(shipment_ids, 50):
+            for shipment_data in self.iter_amazon_inbound_shipments(
+                    mws_connection_api, ShipmentIdList=shipment_ids_batch):
+                statuses[shipment_data.ShipmentId] = \
+                    shipment_data.ShipmentStatus
+        return statuses
+
+    @classmethod
+    def sync_amazon_inbound_shipments_using_cron(cls):
+        """
+        Cron method to sync inbound shipments of all amazon channels with
+        a FBA warehouse
+        """
+        for channel in cls.search([
+                ('source', '=', 'amazon_mws'),
+                ('fba_warehouse', '!=', None)]):
+            channel.sync_amazon_inbound_shipments()
+
+    def sync_amazon_inbound_shipments(self):
+        """
+        Update the internal shipments of the inbound shipments updated on
+        amazon since the last sync.
+
+        The quantities received by the fulfillment center are saved on the
+        moves and the shipments closed on amazon are done.
+        """
+        Shipment = Pool().get('stock.shipment.internal')
+        Move = Pool().get('stock.move')
+        InboundShipmentRequest = Pool().get('inbound_shipment.request')
+
+        self.validate_amazon_channel()
+        mws_connection_api = self.get_mws_boto_connection_api()
+
+        sync_time = datetime.utcnow()
+        last_sync_time = self.last_amazon_inbound_shipment_sync_time or \
+            sync_time - relativedelta(days=30)
+        updated_between = {
+            'LastUpdatedAfter': last_sync_time.strftime(
+                '%Y-%m-%dT%H:%M:%SZ'
+            ),
+            'LastUpdatedBefore': sync_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+
+        statuses = dict(
+            (shipment_data.ShipmentId, shipment_data.ShipmentStatus)
+            for shipment_data in self.iter_amazon_inbound_shipments(
+                mws_connection_api, ShipmentStatusList=[
+                    'WORKING', 'SHIPPED', 'IN_TRANSIT', 'DELIVERED',
+                    'CHECKED_IN', 'RECEIVING', 'CLOSED', 'CANCELLED',
+                    'DELETED', 'ERROR',
+                ], **updated_between
+            )
+        )
+        # (shipment id, SKU) => Quantity received
+        received = dict(
+            ((item_data.ShipmentId, item_data.SellerSKU),
+                int(item_data.QuantityReceived or 0))
+            for item_data in self.iter_amazon_inbound_shipment_items(
+                mws_connection_api, **updated_between
+            )
+        )
+
+        shipment_ids = set(statuses) | set(
+            shipment_id for shipment_id, _ in received
+        )
+        shipments = Shipment.search([
+            ('mws_inbound_shipment_id', 'in', list(shipment_ids)),
+        ]) if shipment_ids else []
+
+        # Moves created before the SKU was saved on them are matched with
+        # the products of the SKUs received, resolved in one go
+        skus_by_product = defaultdict(set)
+        products_by_sku = InboundShipmentRequest.find_products_using_skus(
+            [sku for _, sku in received], self
+        ) if received else {}
+        for sku, product in products_by_sku.iteritems():
+            skus_by_product[product.id].add(sku)
+
+        # Quantity received => Moves
+        moves_by_quantity = defaultdict(list)
+        for shipment in shipments:
+            for move in shipment.moves:
+                if move.amazon_sku:
+                    skus = [move.amazon_sku]
+                else:
+                    skus = skus_by_product[move.product.id]
+                quantity = None
+                for sku in skus:
+                    quantity = received.get(
+                        (shipment.mws_inbound_shipment_id, sku)
+                    )
+                    if quantity is not None:
+                        break
+                if quantity is not None and \
+                        quantity != move.amazon_quantity_received:
+                    moves_by_quantity[quantity].append(move)
+        to_write = []
+        for quantity, moves in moves_by_quantity.iteritems():
+            to_write.extend([moves, {'amazon_quantity_received': quantity}])
+        if to_write:
+            Move.write(*to_write)
+
+        closed = [
+            shipment for shipment in shipments
+            if statuses.get(shipment.mws_inbound_shipment_id) == 'CLOSED'
+        ]
+        Shipment.wait([s for s in closed if s.state == 'draft'])
+        Shipment.assign_try([s for s in closed if s.state == 'waiting'])
+        to_done = [s for s in closed if s.state == 'assigned']
+        if to_done:
+            # Status was just read from amazon
+            with Transaction().set_context(
+                    amazon_inbound_shipment_closed=True):
+                Shipment.done(to_done)
+        for shipment in closed:
+            if shipment.state not in ('assigned', 'done'):
+                logger.warning(
+                    'Inbound shipment %s is closed on amazon but could not '
+                    'be assigned' % shipment.mws_inbound_shipment_id
+                )
+
+        self.write([self], {
+            'last_amazon_inbound_shipment_sync_time': sync_time,
+        })
+
+    def get_amazon_report_api(self):
+        """
+        Return an instance of report api
+        """
+        return mws.Reports(
+            access_key=self.amazon_access_key,
+            secret_key=self.amazon_secret_key,
+            account_id=self.amazon_merchant_id,
+        )
+
     def get_amazon_feed_api(self):
         """
         Return an instance of feed api
@@ -250,46 +541,73 @@ class SaleChannel:
 
         return self.import_mws_order_bulk(orders)
 
-    def import_mws_order_bulk(self, amazon_orders_data):
+    def import_mws_order_bulk(self, amazon_orders_data, enqueue=True):
         """
         It is expensive to get orders one by one and in addition, it will
         throttle the API requests.
+
+        The new orders of the page are created together and put in the
+        order queue, they are processed by the workers of the queue. The
+        orders already imported are updated together.
+
+        :param amazon_orders_data: List of order data from amazon
+        :param enqueue: If False, the new orders are processed right away
+                        instead of being put in the order queue
         """
         Sale = Pool().get('sale.sale')
 
-        sales = []
         order_api = self.get_amazon_order_api()
 
-        for order in amazon_orders_data:
-            already_imported = Sale.search([
+        imported_sales = dict(
+            (sale.channel_identifier, sale) for sale in Sale.search([
                 ('channel', '=', self.id),
-                (
-                    'channel_identifier', '=',
+                ('channel_identifier', 'in', [
                     order['AmazonOrderId']['value']
-                ),
+                    for order in amazon_orders_data
+                ]),
             ])
-            if not already_imported:
-                # New order! get the line items and save the order.
+        )
+
+        new_orders = []
+        new_order_ids = set()
+        sales_to_update = []
+        for order in amazon_orders_data:
+            order_id = order['AmazonOrderId']['value']
+            if order_id in new_order_ids:
+                continue
+            if order_id not in imported_sales:
+                # New order! get the line items, the order is saved with
+                # the other new orders.
                 order_line_data = order_api.list_order_items(
-                    order['AmazonOrderId']['value']
+                    order_id
                 ).parsed
-
-                with Transaction().set_context(
-                    {'current_channel': self.id}
-                ):
-                    sales.append(
-                        Sale.create_using_amazon_data(
-                            order,
-                            order_line_data['OrderItems']['OrderItem']
-                        )
-                    )
+                new_orders.append(
+                    (order, order_line_data['OrderItems']['OrderItem'])
+                )
+                new_order_ids.add(order_id)
             else:
                 # Order is already there, just ensure it is in the
                 # right status
-                sales.append(already_imported[0])
-                already_imported[0].update_order_status_from_amazon_mws(
-                    order
+                sales_to_update.append((imported_sales[order_id], order))
+
+        new_sales = []
+        if new_orders:
+            with Transaction().set_context({'current_channel': self.id}):
+                new_sales = Sale.create_many_using_amazon_data(
+                    new_orders, enqueue=enqueue
                 )
+        new_sales_by_order_id = dict(
+            (sale.channel_identifier, sale) for sale in new_sales
+        )
+
+        Sale.update_orders_status_from_amazon_mws(sales_to_update)
+
+        sales = []
+        for order in amazon_orders_data:
+            order_id = order['AmazonOrderId']['value']
+            sales.append(
+                imported_sales.get(order_id) or new_sales_by_order_id[order_id]
+            )
         return sales
 
     def import_order(self, order_id):
@@ -321,73 +639,415 @@ class SaleChannel:
         if not isinstance(orders, list):
             orders = [orders]
 
-        return self.import_mws_order_bulk(orders)[0]
+        return self.import_mws_order_bulk(orders, enqueue=False)[0]
 
-    def _get_amazon_envelop(self, message_type, xml_list):
+    def get_amazon_feed_writer(self, message_type):
         """
-        Returns amazon envelop for xml given
+        Return a feed writer which streams messages into envelopes of
+        this channel, split at the feed limits of the channel.
+
+        :param message_type: Message type of the envelope
         """
-        NS = "http://www.w3.org/2001/XMLSchema-instance"
-        location_attribute = '{%s}noNamespaceSchemaLocation' % NS
+        max_size = self.amazon_feed_max_size
+        return FeedWriter(
+            self.amazon_merchant_id, message_type,
+            max_messages=self.amazon_feed_max_messages,
+            max_size=max_size and max_size * 1024 * 1024,
+        )
 
-        envelope_xml = E.AmazonEnvelope(
-            E.Header(
-                E.DocumentVersion('1.01'),
-                E.MerchantIdentifier(self.amazon_merchant_id)
-            ),
-            E.MessageType(message_type),
-            E.PurgeAndReplace('false'),
-            *(xml for xml in xml_list)
+    def get_amazon_flat_file_writer(self, header):
+        """
+        Return a writer which streams rows into flat file feeds, split at
+        the feed limits of this channel.
+
+        :param header: List of the column names of the flat file
+        """
+        max_size = self.amazon_feed_max_size
+        return FlatFileWriter(
+            header,
+            max_messages=self.amazon_feed_max_messages,
+            max_size=max_size and max_size * 1024 * 1024,
         )
-        envelope_xml.set(location_attribute, 'amznenvelope.xsd')
 
-        return envelope_xml
+    def submit_amazon_feeds(self, feed_files, feed_type):
+        """
+        Submit the feeds written by a feed writer to amazon and record the
+        submissions, so that their processing reports can be checked later.
+
+        A feed with the same messages as a feed still being processed or
+        recently accepted by amazon is not sent again. It is recorded as
+        skipped and gets the results of that feed.
 
-    def export_product_prices(self):
-        """Export prices of the products to the Amazon account in context
+        If the upload fails, the error is logged and only the feeds sent
+        before the error are recorded. The messages of the other feeds are
+        not in the feeds returned, they are sent again on the next export.
+
+        :param feed_files: List of FeedFile
+        :param feed_type: Amazon feed type enumeration
+        :returns: List of active records of amazon.mws.feed created
+        """
+        submissions = self.prepare_amazon_feeds(feed_files, feed_type)
+        try:
+            self.upload_amazon_feeds(
+                self.get_amazon_feed_api(), self.amazon_marketplace_id,
+                submissions, feed_type
+            )
+        except Exception:
+            # Not raised, the feeds sent before the error must be recorded
+            # and kept when this runs from a cron
+            logger.exception(
+                'Upload of amazon feeds of type %s failed' % feed_type
+            )
+        return self.record_amazon_feeds(submissions)
+
+    @staticmethod
+    def get_amazon_feed_origin_ids(feeds):
+        """
+        Return the ids of the origins of the messages of the feeds
+
+        :param feeds: List of active records of amazon.mws.feed
+        """
+        return set(
+            message.origin.id
+            for feed in feeds for message in feed.messages
+            if message.origin
+        )
+
+    def prepare_amazon_feeds(self, feed_files, feed_type):
+        """
+        Return the values of the feed records to create for the feed files
+        and mark the duplicates of feeds already with amazon as skipped.
+
+        :param feed_files: List of FeedFile
+        :param feed_type: Amazon feed type enumeration
+        :returns: List of (FeedFile, values of amazon.mws.feed)
+        """
+        Feed = Pool().get('amazon.mws.feed')
+
+        submissions = []
+        for feed_file in feed_files:
+            values = {
+                'channel': self.id,
+                'feed_type': feed_type,
+                'md5': feed_file.md5,
+                'content_hash': feed_file.content_hash,
+                'submitted_at': datetime.utcnow(),
+                'messages': [('create', [{
+                    'message_id': message_id,
+                    'origin': origin and '%s,%s' % (
+                        origin.__name__, origin.id
+                    ) or None,
+                } for message_id, origin in feed_file.messages])],
+            }
+
+            duplicate_of = Feed.find_duplicate(
+                self, feed_type, feed_file.content_hash
+            )
+            if duplicate_of is not None:
+                # Same messages are already with amazon, record the feed
+                # without sending it again
+                logger.info(
+                    'Skipping feed of type %s, same as feed %s' % (
+                        feed_type, duplicate_of.submission_id
+                    )
+                )
+                values.update({
+                    'state': 'skipped',
+                    'duplicate_of': duplicate_of.id,
+                })
+            submissions.append((feed_file, values))
+        return submissions
+
+    @staticmethod
+    def upload_amazon_feeds(feeds_api, marketplace_id, submissions,
+                            feed_type):
+        """
+        Send the feeds of the submissions which are not skipped to amazon
+        and set the submission id and state on their values.
+
+        The database is not used, so the feeds of several channels can be
+        uploaded from different threads.
+
+        :param feeds_api: Feeds API of the channel
+        :param marketplace_id: Marketplace ID of the channel
+        :param submissions: List of (FeedFile, values) prepared by
+                            `prepare_amazon_feeds`
+        :param feed_type: Amazon feed type enumeration
+        """
+        for feed_file, values in submissions:
+            if values.get('state') == 'skipped':
+                continue
+            response = feeds_api.submit_feed(
+                feed_file.read(),
+                feed_type=feed_type,
+                marketplaceids=[marketplace_id]
+            ).parsed
+            submission = response['FeedSubmissionInfo']
+            values.update({
+                'submission_id': submission['FeedSubmissionId']['value'],
+                'state': FEED_STATES.get(
+                    submission['FeedProcessingStatus']['value'],
+                    'submitted'
+                ),
+            })
+
+    def record_amazon_feeds(self, submissions):
+        """
+        Create the feed records of the submissions which were sent or
+        skipped.
+
+        :param submissions: List of (FeedFile, values)
+        :returns: List of active records of amazon.mws.feed created
+        """
+        Feed = Pool().get('amazon.mws.feed')
+
+        feed_values = []
+        for feed_file, values in submissions:
+            feed_file.close()
+            if 'state' in values:
+                feed_values.append(values)
+
+        feeds = Feed.create(feed_values)
+
+        # Results of feeds already processed by amazon are known now
+        for feed in feeds:
+            if feed.duplicate_of:
+                feed.process_duplicate()
+
+        return feeds
+
+    def get_amazon_prices(self, products):
+        """
+        Return the prices of the products on amazon, computed with the
+        price list of the channel from the list price of the products.
+
+        The products are matched with the price list lines in one pass and
+        the formula of a line is evaluated once for all the products with
+        the same inputs, instead of computing the price list for each
+        product.
 
         :param products: List of active records of products
+        :returns: Dictionary of product id => price
+        """
+        price_list = self.price_list
+        currency = self.company.currency
+
+        if not price_list:
+            return dict(
+                (product.id, currency.round(product.list_price))
+                for product in products
+            )
+
+        lines = list(price_list.lines)
+
+        # (line id, formula context) => price
+        line_prices = {}
+        prices = {}
+        for product in products:
+            unit_price = product.list_price
+            pattern = {
+                'product': product.id,
+                'quantity': 1,
+            }
+            for line in lines:
+                if line.match(pattern):
+                    break
+            else:
+                prices[product.id] = currency.round(unit_price)
+                continue
+
+            context = price_list._get_context_price_list_line(
+                None, product, unit_price, 1, product.default_uom
+            )
+            key = (line.id, tuple(sorted(context.items())))
+            if key not in line_prices:
+                with Transaction().set_context(context):
+                    line_prices[key] = currency.round(line.get_unit_price())
+            prices[product.id] = line_prices[key]
+        return prices
+
+    def export_product_prices(self, force=False):
+        """Export prices of the products to the Amazon account in context
+
+        Only the listings whose price changed since the last export are
+        sent, unless `force` is set.
+
+        :param force: Export prices of all listings
+        :returns: Number of prices exported
         """
         if self.source != 'amazon_mws':
             return super(SaleChannel, self).export_product_prices()
 
+        if self.amazon_export_mode == 'flat_file':
+            return self.export_amazon_price_and_quantity(force=force)
+
         Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
 
-        products = Product.search([
-            ('code', '!=', None),
-            ('codes', 'not in', []),
-            ('channel_listings.channel', '=', self.id),
-        ])
+        currency_code = self.company.currency.code
 
-        pricing_xml = []
-        for product in products:
-            if self in [
-                ch.channel for ch in product.channel_listings
-            ]:
-                pricing_xml.append(E.Message(
-                    E.MessageID(str(product.id)),
-                    E.OperationType('Update'),
-                    E.Price(
-                        E.SKU(product.code),
-                        E.StandardPrice(
-                            # TODO: Use a pricelist
-                            str(product.list_price),
-                            currency=self.company.currency.code
-                        ),
+        # Fingerprint => Ids of listings exported with it
+        exported_listings = defaultdict(list)
+        with self.get_amazon_feed_writer('Price') as writer:
+            for rows in self.get_amazon_listing_rows():
+                prices = self.get_amazon_prices(
+                    Product.browse(list(set(row[1] for row in rows)))
+                )
+                for listing_id, product_id, sku, old_fingerprint, _ in rows:
+                    price = prices[product_id]
+                    fingerprint = Listing.get_amazon_price_fingerprint(
+                        price, currency_code
                     )
-                ))
+                    if not force and old_fingerprint == fingerprint:
+                        # Price did not change since last export
+                        continue
+
+                    writer.write(E.Message(
+                        E.MessageID(str(listing_id)),
+                        E.OperationType('Update'),
+                        E.Price(
+                            E.SKU(sku),
+                            E.StandardPrice(
+                                str(price), currency=currency_code
+                            ),
+                        )
+                    ), origin=Listing(listing_id))
+                    exported_listings[fingerprint].append(listing_id)
+
+        feeds = self.submit_amazon_feeds(
+            writer.feeds, '_POST_PRODUCT_PRICING_DATA_'
+        )
+        sent_ids = self.get_amazon_feed_origin_ids(feeds)
+
+        # Remember the prices sent so that they are not sent again
+        to_write = []
+        for fingerprint, ids in exported_listings.iteritems():
+            ids = [id_ for id_ in ids if id_ in sent_ids]
+            if ids:
+                to_write.extend([Listing.browse(ids), {
+                    'amazon_price_fingerprint': fingerprint,
+                }])
+        if to_write:
+            Listing.write(*to_write)
+
+        return len(sent_ids)
+
+    def get_amazon_listing_rows(self, listing_ids=None, page_size=1000):
+        """
+        Read the active listings of this channel which have a product and
+        a SKU from the database a page at a time, without instantiating
+        them.
+
+        Yields a list of tuples of (listing id, product id, SKU, price
+        fingerprint, inventory dirty) for each page.
 
-        envelope_xml = self._get_amazon_envelop('Price', pricing_xml)
+        :param listing_ids: Restrict to these listings
+        :param page_size: Number of listings read at once
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        cursor = Transaction().cursor
+        listing = Listing.__table__()
+
+        where = (listing.channel == self.id) & \
+            (listing.product != None) & \
+            (listing.product_identifier != None) & \
+            (listing.state == 'active')  # noqa
+        if listing_ids is not None:
+            if not listing_ids:
+                return
+            where &= listing.id.in_(list(listing_ids))
+
+        last_id = 0
+        while True:
+            cursor.execute(*listing.select(
+                listing.id, listing.product, listing.product_identifier,
+                listing.amazon_price_fingerprint,
+                listing.amazon_inventory_dirty,
+                where=where & (listing.id > last_id),
+                order_by=listing.id.asc, limit=page_size
+            ))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            yield rows
+
+    def export_amazon_price_and_quantity(
+            self, listing_ids=None, force=False):
+        """
+        Export price and quantity of the listings of this channel in a
+        single tab delimited flat file feed.
+
+        The listings are read from the database a page at a time and
+        written to the feed as they are read. Only the listings whose
+        price changed or whose inventory is dirty are sent, unless `force`
+        is set.
 
-        feeds_api = self.get_amazon_feed_api()
+        :param listing_ids: Restrict the export to these listings
+        :param force: Export price and quantity of all listings
+        :returns: Number of listings exported
+        """
+        Product = Pool().get('product.product')
+        Listing = Pool().get('product.product.channel_listing')
+        Date = Pool().get('ir.date')
+
+        currency_code = self.company.currency.code
+
+        # Fingerprint => Ids of listings exported with it
+        exported_listings = defaultdict(list)
+        with self.get_amazon_flat_file_writer(
+                ['sku', 'price', 'quantity', 'handling-time']) as writer:
+            for rows in self.get_amazon_listing_rows(listing_ids):
+                product_ids = list(set(row[1] for row in rows))
+                products = dict(
+                    (product.id, product)
+                    for product in Product.browse(product_ids)
+                )
+                with Transaction().set_context(stock_date_end=Date.today()):
+                    quantities = Product.products_by_location(
+                        [self.warehouse.id], product_ids=product_ids,
+                        with_childs=True
+                    )
+                prices = self.get_amazon_prices(products.values())
+
+                for listing_id, product_id, sku, old_fingerprint, dirty \
+                        in rows:
+                    product = products[product_id]
+                    price = prices[product_id]
+                    fingerprint = Listing.get_amazon_price_fingerprint(
+                        price, currency_code
+                    )
+                    if not force and not dirty and \
+                            old_fingerprint == fingerprint:
+                        continue
 
-        feeds_api.submit_feed(
-            etree.tostring(envelope_xml),
-            feed_type='_POST_PRODUCT_PRICING_DATA_',
-            marketplaceids=[self.amazon_marketplace_id]
+                    quantity = quantities.get(
+                        (self.warehouse.id, product_id), 0
+                    )
+                    writer.write([
+                        sku, str(price), "%d" % max(round(quantity), 0),
+                        "%d" % max(product.delivery_time, 1),
+                    ], origin=Listing(listing_id))
+                    exported_listings[fingerprint].append(listing_id)
+
+        feeds = self.submit_amazon_feeds(
+            writer.feeds, '_POST_FLAT_FILE_PRICEANDQUANTITYONLY_UPDATE_DATA_'
         )
+        sent_ids = self.get_amazon_feed_origin_ids(feeds)
+
+        to_write = []
+        for fingerprint, ids in exported_listings.iteritems():
+            ids = [id_ for id_ in ids if id_ in sent_ids]
+            if ids:
+                to_write.extend([Listing.browse(ids), {
+                    'amazon_price_fingerprint': fingerprint,
+                    'amazon_inventory_dirty': False,
+                }])
+        if to_write:
+            Listing.write(*to_write)
 
-        return len(pricing_xml)
+        return len(sent_ids)
 
     def import_product(self, sku, product_data=None):
         """
@@ -405,6 +1065,10 @@ class SaleChannel:
                 sku, product_data
             )
 
+        listing_ids = Listing.find_using_amazon_sku(self, sku)
+        if listing_ids:
+            return Product(listing_ids[1])
+
         # Check if there is a poduct with the seller SKU.
         # Products being sold as AFN and MFN will have same ASIN.
         # ASIN is unique only in a marketplace, so search asin
@@ -426,7 +1090,7 @@ class SaleChannel:
             if product_data['FulfillmentChannel'] != 'AFN' and \
                     exisiting_listing.product_identifier != sku:
                 exisiting_listing.product_identifier = sku
-                exisiting_listing.product_identifier.save()
+                exisiting_listing.save()
 
             return exisiting_listing.product
 
@@ -464,6 +1128,349 @@ class SaleChannel:
 
         return product
 
+    def request_amazon_report(self, report_type):
+        """
+        Request amazon to generate a report of the given type. Reports
+        are generated asynchronously, use `get_amazon_report` to fetch
+        it once it is ready.
+
+        :param report_type: Amazon report type enumeration
+        :returns: Report request ID
+        """
+        report_api = self.get_amazon_report_api()
+
+        response = report_api.request_report(
+            report_type, marketplaceids=[self.amazon_marketplace_id]
+        ).parsed
+
+        return response['ReportRequestInfo']['ReportRequestId']['value']
+
+    def get_amazon_report(self, request_id):
+        """
+        Return the content of the report generated for the report request
+
+        :param request_id: Report request ID from request_amazon_report
+        :returns: Report content as string, empty string if amazon had no
+                  data for the report and None if it is not generated yet
+        """
+        report_api = self.get_amazon_report_api()
+
+        response = report_api.get_report_request_list(
+            requestids=[request_id]
+        ).parsed
+        request_info = response['ReportRequestInfo']
+        status = request_info['ReportProcessingStatus']['value']
+
+        if status in ('_SUBMITTED_', '_IN_PROGRESS_'):
+            return None
+        if status == '_DONE_NO_DATA_':
+            return ''
+        if status != '_DONE_':
+            self.raise_user_error('report_not_generated', {
+                'report_type': request_info['ReportType']['value'],
+                'status': status,
+            })
+
+        return report_api.get_report(
+            request_info['GeneratedReportId']['value']
+        ).parsed
+
+    @classmethod
+    def import_amazon_listings_using_cron(cls):
+        """
+        Cron method to sync the listings of all amazon channels
+        """
+        channels = cls.search([('source', '=', 'amazon_mws')])
+
+        for channel in channels:
+            channel.import_amazon_listings()
+
+    def import_amazon_listings(self):
+        """
+        Sync listings of this channel with the merchant listings report.
+
+        The report is requested on the first call and imported on a later
+        call once amazon has generated it.
+
+        :returns: List of active records of listings created or updated
+        """
+        self.validate_amazon_channel()
+
+        if not self.amazon_listing_report_request:
+            self.write([self], {
+                'amazon_listing_report_request': self.request_amazon_report(
+                    '_GET_MERCHANT_LISTINGS_DATA_'
+                ),
+            })
+            return []
+
+        try:
+            report = self.get_amazon_report(
+                self.amazon_listing_report_request
+            )
+        except UserError, e:
+            # Report will never be generated, request a new one on next run
+            logger.warning(e.message)
+            self.write([self], {'amazon_listing_report_request': None})
+            return []
+        if report is None:
+            # Report is not generated yet, try on next run
+            return []
+
+        self.write([self], {'amazon_listing_report_request': None})
+
+        return self.import_amazon_listings_from_report(report)
+
+    def import_amazon_listings_from_report(self, report):
+        """
+        Create or update listings from the tab delimited merchant listings
+        report.
+
+        Products being sold as AFN and MFN have the same ASIN and share one
+        listing, the AFN SKU is stored as fba_code and the MFN SKU as the
+        product_identifier of the listing.
+
+        :param report: Content of the merchant listings report
+        :returns: List of active records of listings created or updated
+        """
+        Listing = Pool().get('product.product.channel_listing')
+
+        # ASIN => {'AFN': sku, 'MFN': sku}
+        skus_by_asin = defaultdict(dict)
+        for row in csv.DictReader(StringIO(report), delimiter='\t'):
+            asin = row.get('asin1')
+            if not asin and row.get('product-id-type') == '1':
+                asin = row['product-id']
+            if not asin:
+                continue
+
+            # Fulfillment channel is DEFAULT for merchant fulfilled items
+            # and AMAZON_<REGION> for items fulfilled by amazon
+            if row.get('fulfillment-channel', 'DEFAULT') == 'DEFAULT':
+                skus_by_asin[asin]['MFN'] = row['seller-sku']
+            else:
+                skus_by_asin[asin]['AFN'] = row['seller-sku']
+
+        listings = []
+        to_write = []
+        for asins in batch(skus_by_asin.keys(), 1000):
+            existing_listings = Listing.search([
+                ('asin', 'in', asins),
+                ('channel', '=', self.id),
+            ])
+            for listing in existing_listings:
+                skus = skus_by_asin.pop(listing.asin, None)
+                if skus is None:
+                    # Already handled with another listing of this ASIN
+                    continue
+
+                values = {}
+                if skus.get('AFN') and not listing.fba_code:
+                    values['fba_code'] = skus['AFN']
+                if skus.get('MFN') and \
+                        listing.product_identifier != skus['MFN']:
+                    values['product_identifier'] = skus['MFN']
+                if values:
+                    to_write.extend([[listing], values])
+                    listings.append(listing)
+
+        if to_write:
+            Listing.write(*to_write)
+
+        # Whatever is left in skus_by_asin is not listed yet
+        products_by_sku = self._get_products_for_amazon_skus([
+            asin_skus.get('MFN') or asin_skus['AFN']
+            for asin_skus in skus_by_asin.values()
+        ])
+
+        listing_values = []
+        for asin, skus in skus_by_asin.iteritems():
+            sku = skus.get('MFN') or skus['AFN']
+            if sku not in products_by_sku:
+                continue
+            listing_values.append({
+                'product': products_by_sku[sku].id,
+                'channel': self.id,
+                'product_identifier': sku,
+                'fba_code': skus.get('AFN'),
+                'asin': asin,
+            })
+        listings.extend(Listing.create(listing_values))
+
+        return listings
+
+    @classmethod
+    def sync_amazon_fba_inventory_using_cron(cls):
+        """
+        Cron method to sync the stock of the FBA warehouse of all amazon
+        channels with the inventory held by amazon
+        """
+        for channel in cls.search([
+                ('source', '=', 'amazon_mws'),
+                ('fba_warehouse', '!=', None)]):
+            channel.sync_amazon_fba_inventory()
+
+    def sync_amazon_fba_inventory(self):
+        """
+        Sync the stock of the FBA warehouse of this channel with the AFN
+        inventory report.
+
+        The report is requested on the first call and imported on a later
+        call once amazon has generated it.
+
+        :returns: Active record of the inventory posted or None
+        """
+        self.validate_amazon_channel()
+
+        if not self.amazon_fba_inventory_report_request:
+            self.write([self], {
+                'amazon_fba_inventory_report_request':
+                    self.request_amazon_report('_GET_AFN_INVENTORY_DATA_'),
+            })
+            return None
+
+        try:
+            report = self.get_amazon_report(
+                self.amazon_fba_inventory_report_request
+            )
+        except UserError, e:
+            # Report will never be generated, request a new one on next run
+            logger.warning(e.message)
+            self.write([self], {'amazon_fba_inventory_report_request': None})
+            return None
+        if report is None:
+            # Report is not generated yet, try on next run
+            return None
+
+        self.write([self], {'amazon_fba_inventory_report_request': None})
+
+        return self.sync_amazon_fba_inventory_from_report(report)
+
+    def sync_amazon_fba_inventory_from_report(self, report):
+        """
+        Post an inventory of the FBA warehouse with the sellable quantities
+        of the tab delimited AFN inventory report. Only the products whose
+        quantity differs from amazon are in the inventory.
+
+        :param report: Content of the AFN inventory report
+        :returns: Active record of the inventory posted or None
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        Product = Pool().get('product.product')
+        Inventory = Pool().get('stock.inventory')
+        Location = Pool().get('stock.location')
+        Date = Pool().get('ir.date')
+
+        # SKU => Quantity sellable at amazon
+        quantities_by_sku = defaultdict(int)
+        for row in csv.DictReader(StringIO(report), delimiter='\t'):
+            if row.get('Warehouse-Condition-code', 'SELLABLE') != 'SELLABLE':
+                continue
+            quantities_by_sku[row['seller-sku']] += int(
+                row.get('Quantity Available') or 0
+            )
+        if not quantities_by_sku:
+            return None
+
+        # Product id => Quantity at amazon
+        quantities = defaultdict(int)
+        for skus in batch(quantities_by_sku.keys(), 1000):
+            for listing in Listing.search([
+                    ('channel', '=', self.id),
+                    ('product', '!=', None),
+                    ['OR',
+                        ('fba_code', 'in', skus),
+                        ('product_identifier', 'in', skus)]]):
+                sku = listing.fba_code if listing.fba_code in \
+                    quantities_by_sku else listing.product_identifier
+                quantities[listing.product.id] += quantities_by_sku.pop(
+                    sku, 0
+                )
+        if not quantities:
+            return None
+
+        location = self.fba_warehouse.storage_location
+        today = Date.today()
+        with Transaction().set_context(stock_date_end=today):
+            expected_quantities = Product.products_by_location(
+                [location.id], product_ids=quantities.keys(),
+                with_childs=True
+            )
+
+        lines = []
+        for product_id, quantity in quantities.iteritems():
+            expected_quantity = expected_quantities.get(
+                (location.id, product_id), 0
+            )
+            if quantity == expected_quantity:
+                continue
+            lines.append({
+                'product': product_id,
+                'expected_quantity': expected_quantity,
+                'quantity': quantity,
+            })
+        if not lines:
+            return None
+
+        lost_found, = Location.search([('type', '=', 'lost_found')], limit=1)
+        inventory, = Inventory.create([{
+            'location': location.id,
+            'lost_found': lost_found.id,
+            'company': self.company.id,
+            'date': today,
+            'lines': [('create', lines)],
+        }])
+        Inventory.confirm([inventory])
+        return inventory
+
+    def _get_products_for_amazon_skus(self, skus):
+        """
+        Return a map of SKU to product for the given SKUs. Products which
+        do not exist yet are created using the catalog data from amazon.
+
+        :param skus: List of seller SKUs
+        :returns: Dictionary of SKU => Active record of product
+        """
+        Product = Pool().get('product.product')
+
+        products_by_sku = {}
+        for skus_batch in batch(skus, 1000):
+            for product in Product.search([('code', 'in', skus_batch)]):
+                products_by_sku[product.code] = product
+
+        missing_skus = [sku for sku in skus if sku not in products_by_sku]
+        if not missing_skus:
+            return products_by_sku
+
+        product_api = self.get_amazon_product_api()
+        products_data = []
+        for skus_batch in batch(missing_skus, 5):
+            # The matching product API accepts a maximum of 5 IDs per
+            # request. If the request quota is exhausted, create what is
+            # fetched so far and leave the rest for the next sync.
+            try:
+                response = product_api.get_matching_product_for_id(
+                    self.amazon_marketplace_id, 'SellerSKU', skus_batch
+                ).parsed
+            except mws.MWSError, e:
+                logger.warning(e.message)
+                break
+
+            if not isinstance(response, list):
+                response = [response]
+            products_data.extend(
+                data for data in response
+                if data['status']['value'] == 'Success'
+            )
+
+        with Transaction().set_context(current_channel=self.id):
+            products = Product.create_many_using_amazon_data(products_data)
+
+        for product in products:
+            products_by_sku[product.code] = product
+
+        return products_by_sku
+
     def import_order_states(self):
         """
         Import order states for amazon channel
@@ -563,6 +1570,9 @@ class SaleChannel:
             ('state', 'in', ('confirmed', 'processing')),
         ])
         order_ids = [sale.channel_identifier for sale in sales]
+        sales_by_order_id = dict(
+            (sale.channel_identifier, sale) for sale in sales
+        )
 
         for order_ids_batch in batch(order_ids, 50):
             # The order fetch API limits getting orders to a maximum
@@ -582,11 +1592,10 @@ class SaleChannel:
             else:
                 orders = response['Orders']['Order']
 
-            for order in orders:
-                sale, = Sale.search([
-                    ('channel_identifier', '=', order['AmazonOrderId']['value'])
-                ])
-                sale.update_order_status_from_amazon_mws(order)
+            Sale.update_orders_status_from_amazon_mws([
+                (sales_by_order_id[order['AmazonOrderId']['value']], order)
+                for order in orders
+            ])
 
 
 class CheckAmazonServiceStatusView(ModelView):
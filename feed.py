@@ -0,0 +1,787 @@
+# -*- coding: utf-8 -*-
+"""
+    feed
+
+    Amazon MWS Feeds
+
+"""
+import re
+import csv
+import base64
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from collections import defaultdict
+from tempfile import TemporaryFile
+from StringIO import StringIO
+
+from lxml import etree
+from lxml.builder import E
+from mws import mws
+
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+
+__metaclass__ = PoolMeta
+
+__all__ = ['AmazonFeed', 'AmazonFeedMessage']
+
+XSI_NS = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Amazon feed processing status => state of feed
+FEED_STATES = {
+    '_SUBMITTED_': 'submitted',
+    '_AWAITING_ASYNCHRONOUS_REPLY_': 'in_progress',
+    '_IN_PROGRESS_': 'in_progress',
+    '_IN_SAFETY_NET_': 'in_progress',
+    '_UNCONFIRMED_': 'in_progress',
+    '_DONE_': 'done',
+    '_CANCELLED_': 'cancelled',
+}
+
+logger = logging.getLogger("amazon_mws")
+
+
+def parse_processing_report(source):
+    """
+    Stream parse the processing report of a feed submission.
+
+    Yields a tuple of ('summary', values) for the processing summary and a
+    tuple of ('result', values) for each result of a message with an
+    error or a warning.
+
+    :param source: File like object with the processing report
+    """
+    for _, element in etree.iterparse(
+            source, tag=('ProcessingSummary', 'Result')):
+        if element.tag == 'ProcessingSummary':
+            yield 'summary', {
+                'processed': int(
+                    element.findtext('MessagesProcessed') or 0
+                ),
+                'successful': int(
+                    element.findtext('MessagesSuccessful') or 0
+                ),
+                'with_error': int(
+                    element.findtext('MessagesWithError') or 0
+                ),
+                'with_warning': int(
+                    element.findtext('MessagesWithWarning') or 0
+                ),
+            }
+        else:
+            yield 'result', {
+                'message_id': element.findtext('MessageID'),
+                'code': element.findtext('ResultCode'),
+                'message_code': element.findtext('ResultMessageCode'),
+                'description': element.findtext('ResultDescription'),
+            }
+        element.clear()
+
+
+# Line of the summary of a flat file processing report => summary key
+FLAT_FILE_SUMMARY = [
+    ('processed', re.compile(r'records processed\s+(\d+)')),
+    ('successful', re.compile(r'records successful\s+(\d+)')),
+]
+
+
+def parse_flat_file_processing_report(source):
+    """
+    Parse the tab delimited processing report of a flat file feed
+    submission.
+
+    Yields the same values as `parse_processing_report`. The message id of
+    a result is the record number of the row in the flat file.
+
+    :param source: File like object with the processing report
+    """
+    summary = {'with_error': 0, 'with_warning': 0}
+    results = []
+    columns = None
+    for line in source:
+        line = line.rstrip('\r\n')
+        if columns is None:
+            for key, pattern in FLAT_FILE_SUMMARY:
+                match = pattern.search(line)
+                if match:
+                    summary[key] = int(match.group(1))
+            if line.startswith('original-record-number'):
+                columns = line.split('\t')
+            continue
+        if not line.strip():
+            continue
+        row = dict(zip(columns, line.split('\t')))
+        results.append({
+            'message_id': row.get('original-record-number'),
+            'code': row.get('error-type'),
+            'message_code': row.get('error-code'),
+            'description': row.get('error-message'),
+        })
+        if row.get('error-type') == 'Warning':
+            summary['with_warning'] += 1
+        else:
+            summary['with_error'] += 1
+
+    yield 'summary', summary
+    for result in results:
+        yield 'result', result
+
+
+class FeedFile(object):
+    """
+    A feed written to a temporary file. The size and MD5 checksum of the
+    content are computed while it is written.
+    """
+
+    def __init__(self):
+        self.file = TemporaryFile()
+        self.size = 0
+        #: List of (message id, origin) of the messages in the feed
+        self.messages = []
+        self._md5 = hashlib.md5()
+        self._content_hash = hashlib.sha1()
+
+    def write(self, data):
+        self._md5.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def update_content_hash(self, data):
+        """
+        Add the content of a message, without its message id, to the
+        content hash
+        """
+        self._content_hash.update(data)
+
+    @property
+    def message_ids(self):
+        return [message_id for message_id, _ in self.messages]
+
+    @property
+    def message_count(self):
+        return len(self.messages)
+
+    @property
+    def md5(self):
+        "Hex digest of the content"
+        return self._md5.hexdigest()
+
+    @property
+    def content_hash(self):
+        """
+        Hex digest of the messages without their message ids. Feeds with
+        the same messages have the same content hash, whatever their
+        message ids are.
+        """
+        return self._content_hash.hexdigest()
+
+    @property
+    def content_md5(self):
+        "Base64 encoded digest of the content as used in Content-MD5 header"
+        return base64.b64encode(self._md5.digest())
+
+    def read(self):
+        """
+        Return the content of the feed
+        """
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+
+class FeedWriter(object):
+    """
+    Streams messages into amazon envelopes written to temporary files,
+    without building the whole document in memory.
+
+    A new feed is started once the current one reaches `max_messages`
+    messages or `max_size` bytes, so that no feed goes over the limits of
+    amazon.
+
+    Usage::
+
+        with FeedWriter(merchant_id, 'Price') as writer:
+            for message in messages:
+                writer.write(message)
+        for feed_file in writer.feeds:
+            submit(feed_file.read())
+    """
+
+    def __init__(
+            self, merchant_id, message_type, max_messages=None,
+            max_size=None):
+        self.merchant_id = merchant_id
+        self.message_type = message_type
+        self.max_messages = max_messages
+        self.max_size = max_size
+
+        #: List of FeedFile written, the last one is being written till
+        #: the writer is closed
+        self.feeds = []
+
+        self._current = None
+        self._size = 0
+        self._contexts = []
+        self._xf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _open(self):
+        self._current = FeedFile()
+        self.feeds.append(self._current)
+
+        xmlfile = etree.xmlfile(self._current, encoding='utf-8')
+        self._xf = xmlfile.__enter__()
+        self._contexts.append(xmlfile)
+
+        self._xf.write_declaration()
+        envelope = self._xf.element('AmazonEnvelope', {
+            '{%s}noNamespaceSchemaLocation' % XSI_NS: 'amznenvelope.xsd',
+        }, nsmap={'xsi': XSI_NS})
+        envelope.__enter__()
+        self._contexts.append(envelope)
+
+        self._xf.write(E.Header(
+            E.DocumentVersion('1.01'),
+            E.MerchantIdentifier(self.merchant_id)
+        ))
+        self._xf.write(E.MessageType(self.message_type))
+        self._xf.write(E.PurgeAndReplace('false'))
+        self._size = 0
+
+    def _close_current(self):
+        while self._contexts:
+            self._contexts.pop().__exit__(None, None, None)
+        self._current = None
+        self._xf = None
+
+    def _is_full(self, size):
+        """
+        Return True if a message of the given size does not fit in the
+        current feed
+        """
+        if self.max_messages and \
+                self._current.message_count >= self.max_messages:
+            return True
+        return bool(self.max_size) and self._size + size > self.max_size
+
+    def write(self, message, origin=None):
+        """
+        Write the message element to the current feed
+
+        :param message: Message element of the envelope
+        :param origin: Record the message is sent for
+        """
+        size = len(etree.tostring(message))
+
+        if self._current is not None and self._is_full(size):
+            self._close_current()
+
+        if self._current is None:
+            self._open()
+
+        self._xf.write(message)
+        self._size += size
+        for element in message:
+            if element.tag != 'MessageID':
+                self._current.update_content_hash(etree.tostring(element))
+        self._current.messages.append(
+            (message.findtext('MessageID'), origin)
+        )
+
+    def close(self):
+        """
+        Finish the feed being written
+
+        :returns: List of FeedFile written
+        """
+        if self._current is not None:
+            self._close_current()
+        return self.feeds
+
+
+class FlatFileWriter(object):
+    """
+    Streams rows into tab delimited flat file feeds written to temporary
+    files. Like `FeedWriter`, a new feed is started once the current one
+    reaches `max_messages` rows or `max_size` bytes.
+
+    The message id of a row is its record number in the feed, which is how
+    amazon refers to it in the processing report.
+
+    :param header: List of the column names of the flat file
+    """
+
+    def __init__(self, header, max_messages=None, max_size=None):
+        self.header = header
+        self.max_messages = max_messages
+        self.max_size = max_size
+
+        #: List of FeedFile written
+        self.feeds = []
+
+        self._current = None
+        self._buffer = StringIO()
+        self._writer = csv.writer(
+            self._buffer, delimiter='\t', lineterminator='\n',
+            quoting=csv.QUOTE_NONE, escapechar='\\'
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _format(self, row):
+        """
+        Return the row as a line of the flat file
+        """
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._writer.writerow([
+            value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row
+        ])
+        return self._buffer.getvalue()
+
+    def _open(self):
+        self._current = FeedFile()
+        self.feeds.append(self._current)
+        self._current.write(self._format(self.header))
+
+    def _is_full(self, size):
+        """
+        Return True if a row of the given size does not fit in the current
+        feed
+        """
+        if self.max_messages and \
+                self._current.message_count >= self.max_messages:
+            return True
+        if not self.max_size:
+            return False
+        return self._current.size + size > self.max_size
+
+    def write(self, row, origin=None):
+        """
+        Write the row to the current feed
+
+        :param row: List of values of the columns of the header
+        :param origin: Record the row is sent for
+        """
+        line = self._format(row)
+
+        if self._current is not None and self._is_full(len(line)):
+            self._current = None
+
+        if self._current is None:
+            self._open()
+
+        self._current.write(line)
+        self._current.update_content_hash(line)
+        self._current.messages.append(
+            (str(self._current.message_count + 1), origin)
+        )
+
+    def close(self):
+        """
+        Finish the feed being written
+
+        :returns: List of FeedFile written
+        """
+        self._current = None
+        return self.feeds
+
+
+class AmazonFeed(ModelSQL, ModelView):
+    "Amazon MWS Feed"
+    __name__ = 'amazon.mws.feed'
+    _rec_name = 'submission_id'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True, select=True
+    )
+    submission_id = fields.Char(
+        'Feed Submission ID', readonly=True, select=True
+    )
+    feed_type = fields.Char('Feed Type', required=True, readonly=True)
+    state = fields.Selection([
+        ('submitted', 'Submitted'),
+        ('in_progress', 'In Progress'),
+        ('done', 'Done'),
+        ('cancelled', 'Cancelled'),
+        ('skipped', 'Skipped'),
+    ], 'State', required=True, readonly=True, select=True)
+    submitted_at = fields.DateTime('Submitted At', readonly=True)
+    processed_at = fields.DateTime('Processed At', readonly=True)
+    md5 = fields.Char('MD5', readonly=True)
+    content_hash = fields.Char(
+        'Content Hash', readonly=True, select=True,
+        help="Hash of the messages of the feed without their message IDs"
+    )
+    duplicate_of = fields.Many2One(
+        'amazon.mws.feed', 'Duplicate Of', readonly=True, states={
+            'invisible': ~Eval('duplicate_of'),
+        }
+    )
+    messages = fields.One2Many(
+        'amazon.mws.feed.message', 'feed', 'Messages', readonly=True
+    )
+    messages_processed = fields.Integer('Messages Processed', readonly=True)
+    messages_successful = fields.Integer('Messages Successful', readonly=True)
+    messages_with_error = fields.Integer('Messages With Error', readonly=True)
+    messages_with_warning = fields.Integer(
+        'Messages With Warning', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(AmazonFeed, cls).__setup__()
+        cls._order.insert(0, ('submitted_at', 'DESC'))
+
+    #: Feeds accepted by amazon in this period are not submitted again
+    _duplicate_period = timedelta(hours=1)
+
+    @staticmethod
+    def default_state():
+        return 'submitted'
+
+    @classmethod
+    def find_duplicate(cls, channel, feed_type, content_hash):
+        """
+        Return the last feed of the type sent for the channel if it has the
+        same messages and is still being processed or was recently accepted
+        by amazon.
+
+        Only the last feed is compared, an older feed with the same messages
+        could have been overridden by the feeds sent after it.
+
+        :param channel: Active record of channel
+        :param feed_type: Amazon feed type enumeration
+        :param content_hash: Content hash of the feed to submit
+        :returns: Active record of feed or None
+        """
+        feeds = cls.search([
+            ('channel', '=', channel.id),
+            ('feed_type', '=', feed_type),
+            ('state', '!=', 'skipped'),
+        ], order=[('submitted_at', 'DESC'), ('id', 'DESC')], limit=1)
+        if not feeds:
+            return None
+
+        feed, = feeds
+        if feed.content_hash != content_hash:
+            return None
+        if feed.state in ('submitted', 'in_progress'):
+            return feed
+        if feed.state == 'done' and not feed.messages_with_error and \
+                feed.submitted_at >= \
+                datetime.utcnow() - cls._duplicate_period:
+            return feed
+        return None
+
+    @classmethod
+    def check_status_using_cron(cls):
+        """
+        Cron method to check the status of the feeds being processed by
+        amazon
+        """
+        cls.check_status(cls.search([
+            ('state', 'in', ('submitted', 'in_progress')),
+        ]))
+
+    @classmethod
+    def check_status(cls, feeds):
+        """
+        Check the processing status of the feeds with amazon, in batches
+        per channel, and process the report of the feeds which are done.
+        The messages of the feeds cancelled by amazon are failed.
+
+        :param feeds: List of active records of feeds
+        """
+        feeds_by_channel = defaultdict(list)
+        for feed in feeds:
+            feeds_by_channel[feed.channel].append(feed)
+
+        for channel, channel_feeds in feeds_by_channel.iteritems():
+            feeds_api = channel.get_amazon_feed_api()
+
+            # Amazon accepts a maximum of 100 submission IDs per request
+            for index in range(0, len(channel_feeds), 100):
+                feeds_batch = channel_feeds[index:index + 100]
+                try:
+                    response = feeds_api.get_feed_submission_list(
+                        feedids=[feed.submission_id for feed in feeds_batch]
+                    ).parsed
+                except mws.MWSError, e:
+                    # Throttled, check the rest on next run
+                    logger.warning(e.message)
+                    break
+
+                submissions = response.get('FeedSubmissionInfo', [])
+                if isinstance(submissions, dict):
+                    submissions = [submissions]
+                states = dict(
+                    (
+                        submission['FeedSubmissionId']['value'],
+                        FEED_STATES.get(
+                            submission['FeedProcessingStatus']['value'],
+                            'in_progress'
+                        ),
+                    ) for submission in submissions
+                )
+
+                if not cls.update_states(feeds_batch, states, feeds_api):
+                    # Throttled, check the rest on next run
+                    break
+
+    @classmethod
+    def update_states(cls, feeds, states, feeds_api):
+        """
+        Save the processing status of the feeds and process the report of
+        the feeds which are done.
+
+        :param feeds: List of active records of feeds
+        :param states: Dictionary of submission id => state of the feed
+        :param feeds_api: Feeds API of the channel of the feeds
+        :returns: False if amazon throttled the reports, the reports left
+                  are fetched on next run
+        """
+        throttled = False
+        to_write = defaultdict(list)
+        for feed in feeds:
+            state = states.get(feed.submission_id, feed.state)
+            if state == 'done':
+                if throttled:
+                    continue
+                try:
+                    feed.process_report(feeds_api)
+                except mws.MWSError, e:
+                    logger.warning(e.message)
+                    throttled = True
+            elif state == 'cancelled':
+                feed.process_cancellation()
+            elif state != feed.state:
+                to_write[state].append(feed)
+        for state, state_feeds in to_write.iteritems():
+            cls.write(state_feeds, {'state': state})
+        return not throttled
+
+    def process_report(self, feeds_api=None):
+        """
+        Fetch the processing report of the feed and update the result of
+        each message. The origins of the messages are notified so that
+        only the failed ones are sent again.
+        """
+        if feeds_api is None:
+            feeds_api = self.channel.get_amazon_feed_api()
+
+        report = feeds_api.get_feed_submission_result(
+            self.submission_id
+        ).original
+
+        if self.feed_type.startswith('_POST_FLAT_FILE_'):
+            parse = parse_flat_file_processing_report
+        else:
+            parse = parse_processing_report
+
+        summary = {}
+        results = {}
+        for kind, values in parse(StringIO(report)):
+            if kind == 'summary':
+                summary = values
+            else:
+                results[values['message_id']] = values
+
+        message_results = []
+        for message in self.messages:
+            result = results.get(message.message_id)
+            if not summary.get('processed'):
+                # Nothing was processed, the feed as a whole was rejected
+                state = 'error'
+                result = result or results.get('0')
+            elif result is None:
+                state = 'success'
+            elif result['code'] == 'Warning':
+                state = 'warning'
+            else:
+                state = 'error'
+            message_results.append(
+                (message, state, result and result['description'])
+            )
+
+        self.set_message_results(message_results, {
+            'messages_processed': summary.get('processed'),
+            'messages_successful': summary.get('successful'),
+            'messages_with_error': summary.get('with_error'),
+            'messages_with_warning': summary.get('with_warning'),
+        })
+
+        for duplicate in self.search([('duplicate_of', '=', self.id)]):
+            duplicate.process_duplicate()
+
+    def process_duplicate(self):
+        """
+        Copy the results of the messages of the feed this feed is a
+        duplicate of. The messages of both feeds are the same, in the same
+        order.
+        """
+        original = self.duplicate_of
+        if original.state == 'cancelled':
+            self.process_cancellation()
+            return
+        if original.state != 'done':
+            return
+
+        original_messages = sorted(original.messages, key=lambda m: m.id)
+        messages = sorted(self.messages, key=lambda m: m.id)
+        self.set_message_results([
+            (message, original_message.state, original_message.result)
+            for message, original_message in zip(
+                messages, original_messages
+            )
+        ], {
+            'messages_processed': original.messages_processed,
+            'messages_successful': original.messages_successful,
+            'messages_with_error': original.messages_with_error,
+            'messages_with_warning': original.messages_with_warning,
+        })
+
+    def process_cancellation(self):
+        """
+        Mark the messages of the feed cancelled by amazon as failed and
+        notify their origins, so that they are sent again.
+        """
+        self.set_message_results([
+            (message, 'error', 'Feed was cancelled by amazon')
+            for message in self.messages
+        ], {}, feed_state='cancelled')
+
+        for duplicate in self.search([('duplicate_of', '=', self.id)]):
+            duplicate.process_duplicate()
+
+    def set_message_results(
+            self, message_results, summary, feed_state='done'):
+        """
+        Save the results of the messages and the summary on the feed and
+        notify the origins of the messages.
+
+        :param message_results: List of (message, state, description)
+        :param summary: Dictionary of the message counters of the feed
+        :param feed_state: State of the feed, unless it was skipped
+        """
+        Message = Pool().get('amazon.mws.feed.message')
+
+        # (state, description) => Messages
+        messages_by_result = defaultdict(list)
+        for message, state, description in message_results:
+            messages_by_result[(state, description)].append(message)
+
+        to_write = []
+        for (state, description), messages in \
+                messages_by_result.iteritems():
+            values = {'state': state}
+            if description is not None:
+                values['result'] = description
+            to_write.extend([messages, values])
+        if to_write:
+            Message.write(*to_write)
+
+        values = {
+            'processed_at': datetime.utcnow(),
+        }
+        if self.state != 'skipped':
+            values['state'] = feed_state
+        values.update(summary)
+        self.write([self], values)
+
+        self.notify_origins(
+            [message for message, state, _ in message_results
+                if state == 'error'],
+            'handle_amazon_feed_errors'
+        )
+        self.notify_origins(
+            [message for message, state, _ in message_results
+                if state != 'error'],
+            'handle_amazon_feed_success'
+        )
+
+    def notify_origins(self, messages, method_name):
+        """
+        Call the classmethod `method_name` on the model of the origins of
+        the messages with the feed and the origin records, if the model
+        implements it.
+
+        Models implement `handle_amazon_feed_errors` to resend the failed
+        messages and `handle_amazon_feed_success` to know the messages
+        which were processed.
+
+        :param messages: List of active records of messages
+        :param method_name: Name of the classmethod to call
+        """
+        pool = Pool()
+
+        origins = defaultdict(list)
+        for message in messages:
+            if message.origin:
+                origins[message.origin.__name__].append(message.origin)
+
+        for model_name, records in origins.iteritems():
+            Model = pool.get(model_name)
+            if hasattr(Model, method_name):
+                getattr(Model, method_name)(self, records)
+
+
+class AmazonFeedMessage(ModelSQL, ModelView):
+    "Amazon MWS Feed Message"
+    __name__ = 'amazon.mws.feed.message'
+    _rec_name = 'message_id'
+
+    feed = fields.Many2One(
+        'amazon.mws.feed', 'Feed', required=True, readonly=True,
+        select=True, ondelete='CASCADE'
+    )
+    message_id = fields.Char(
+        'Message ID', required=True, readonly=True, select=True
+    )
+    origin = fields.Reference(
+        'Origin', selection='get_origin', readonly=True, select=True
+    )
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('success', 'Success'),
+        ('warning', 'Warning'),
+        ('error', 'Error'),
+    ], 'State', required=True, readonly=True, select=True)
+    result = fields.Text('Result', readonly=True)
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @classmethod
+    def _get_origin(cls):
+        """
+        Return list of models which can be the origin of a message
+        """
+        return [
+            'product.product.channel_listing', 'sale.sale',
+            'amazon.mws.fulfillment',
+        ]
+
+    @classmethod
+    def get_origin(cls):
+        IrModel = Pool().get('ir.model')
+
+        models = IrModel.search([
+            ('model', 'in', cls._get_origin()),
+        ])
+        return [(None, '')] + [(m.model, m.name) for m in models]
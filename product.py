@@ -3,11 +3,14 @@
     product
 
 '''
+import logging
 from decimal import Decimal
-from lxml import etree
 from lxml.builder import E
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
+from trytond import backend
+from trytond.cache import Cache
 from trytond.model import fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
@@ -19,6 +22,8 @@ __all__ = [
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger("amazon_mws")
+
 
 class Template:
     "Product Template"
@@ -51,15 +56,21 @@ class Product:
     def get_codes(cls, products, names):
         ProductCode = Pool().get('product.product.code')
 
-        res = {}
-        for name in names:
-            res[name] = {}
-            for product in products:
-                code = ProductCode.search([
-                    ('product', '=', product.id),
-                    ('code_type', '=', name)
-                ])
-                res[name][product.id] = code and code[0].id or None
+        res = dict(
+            (name, dict.fromkeys(map(int, products))) for name in names
+        )
+
+        # Read the codes of all products and requested types at once and
+        # pivot them by type and product. Codes come back in the default
+        # order, so the first code of a type is the one that is used.
+        codes = ProductCode.search_read([
+            ('product', 'in', map(int, products)),
+            ('code_type', 'in', names),
+        ], fields_names=['product', 'code_type'])
+        for code in codes:
+            by_product = res[code['code_type']]
+            if by_product[code['product']] is None:
+                by_product[code['product']] = code['id']
 
         return res
 
@@ -104,52 +115,85 @@ class Product:
         :param product_data: Product Data from Amazon
         :returns: Active record of product created
         """
-        Template = Pool().get('product.template')
-        Currency = Pool().get('currency.currency')
-        SaleChannel = Pool().get('sale.channel')
+        return cls.create_many_using_amazon_data([product_data])[0]
 
+    @classmethod
+    def get_amazon_product_attributes(cls, product_data):
+        """
+        Return the item attributes from the product data returned by
+        the amazon product api
+        """
         # TODO: Handle attribute sets in multiple languages
         product_attribute_set = product_data['Products']['Product'][
             'AttributeSets'
         ]
         if isinstance(product_attribute_set, dict):
-            product_attributes = product_attribute_set['ItemAttributes']
-        else:
-            product_attributes = product_attribute_set[0]['ItemAttributes']
+            return product_attribute_set['ItemAttributes']
+        return product_attribute_set[0]['ItemAttributes']
 
-        product_values = cls.extract_product_values_from_amazon_data(
-            product_attributes
-        )
+    @classmethod
+    def create_many_using_amazon_data(cls, products_data):
+        """
+        Create new products with the list of `products_data` from amazon.
+        All the templates are created with a single create call.
+
+        :param products_data: List of product data from Amazon
+        :returns: List of active records of products created, in the same
+                  order as products_data
+        """
+        Template = Pool().get('product.template')
+        Currency = Pool().get('currency.currency')
+        SaleChannel = Pool().get('sale.channel')
+
+        if not products_data:
+            return []
 
         amazon_channel = SaleChannel(
             Transaction().context['current_channel']
         )
         assert amazon_channel.source == 'amazon_mws'
+        company_currency = amazon_channel.company.currency
 
-        list_price = Decimal('0.01')
-        if product_attributes.get('ListPrice'):
-            list_price = product_attributes['ListPrice']['Amount']['value']
-            currency_code = product_attributes['ListPrice']['CurrencyCode']['value']  # noqa
-            currency, = Currency.search([
-                ('code', '=', currency_code),
-            ], limit=1)
-            list_price = Currency.compute(
-                currency, Decimal(list_price),
-                amazon_channel.company.currency
+        # Amazon returns prices in very few currencies, so look up each
+        # of them only once for the whole batch
+        currencies = {}
+
+        templates_values = []
+        for product_data in products_data:
+            product_attributes = cls.get_amazon_product_attributes(
+                product_data
+            )
+
+            product_values = cls.extract_product_values_from_amazon_data(
+                product_attributes
             )
 
-        product_values.update({
-            'products': [('create', [{
-                'code': product_data['Id']['value'],
-                'list_price': list_price,
-                'cost_price': list_price,
-                'description': product_attributes['Title']['value'],
-            }])],
-        })
+            list_price = Decimal('0.01')
+            if product_attributes.get('ListPrice'):
+                list_price = product_attributes['ListPrice']['Amount']['value']
+                currency_code = product_attributes['ListPrice']['CurrencyCode']['value']  # noqa
+                if currency_code not in currencies:
+                    currencies[currency_code], = Currency.search([
+                        ('code', '=', currency_code),
+                    ], limit=1)
+                list_price = Currency.compute(
+                    currencies[currency_code], Decimal(list_price),
+                    company_currency
+                )
+
+            product_values.update({
+                'products': [('create', [{
+                    'code': product_data['Id']['value'],
+                    'list_price': list_price,
+                    'cost_price': list_price,
+                    'description': product_attributes['Title']['value'],
+                }])],
+            })
+            templates_values.append(product_values)
 
-        product_template, = Template.create([product_values])
+        templates = Template.create(templates_values)
 
-        return product_template.products[0]
+        return [template.products[0] for template in templates]
 
 
 class ProductCode:
@@ -170,6 +214,47 @@ class ProductCode:
         ])
 
 
+def _write_amazon_inventory_feed(args):
+    """
+    Write the inventory messages of a channel with its feed writer
+
+    :param args: Tuple of (FeedWriter, list of inventory rows)
+    :returns: List of FeedFile written
+    """
+    writer, rows = args
+    with writer:
+        for _, sku, quantity, delivery_time, listing in rows:
+            # Results of the processing report are matched with the
+            # listings by message id
+            writer.write(E.Message(
+                E.MessageID(str(listing.id)),
+                E.OperationType('Update'),
+                E.Inventory(
+                    E.SKU(sku),
+                    E.Quantity("%d" % round(quantity)),
+                    E.FulfillmentLatency("%d" % max(delivery_time, 1)),
+                )
+            ), origin=listing)
+    return writer.feeds
+
+
+def _upload_amazon_feeds(args):
+    """
+    Upload the feeds of a channel and return the error which stopped the
+    upload, if any. Errors are returned instead of raised so that the
+    feeds uploaded for the other channels are still recorded.
+
+    :param args: Tuple of `SaleChannel.upload_amazon_feeds` and its
+                 arguments
+    """
+    upload = args[0]
+    try:
+        upload(*args[1:])
+    except Exception, e:
+        logger.exception('Upload of amazon feeds failed')
+        return e
+
+
 class ProductSaleChannelListing:
     "Product Sale Channel"
     __name__ = 'product.product.channel_listing'
@@ -183,6 +268,107 @@ class ProductSaleChannelListing:
         'invisible': Eval('channel_source') == 'amazon_mws',
     }, depends=['channel_source'])
 
+    amazon_price_fingerprint = fields.Char(
+        'Amazon Price Fingerprint', readonly=True,
+        help="Price and currency last exported to amazon"
+    )
+
+    amazon_inventory_dirty = fields.Boolean(
+        'Amazon Inventory Dirty', readonly=True, select=True,
+        help="Stock of the product changed since the inventory was last "
+        "exported to amazon"
+    )
+
+    #: Maximum number of channels whose inventory is exported at once
+    _amazon_export_threads = 8
+
+    # (channel id, sku) => (listing id, product id)
+    _amazon_sku_cache = Cache(
+        'product.product.channel_listing.amazon_sku', size_limit=10240,
+        context=False
+    )
+
+    @staticmethod
+    def default_amazon_inventory_dirty():
+        return True
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+
+        super(ProductSaleChannelListing, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+
+        # Listings are looked up by SKU, ASIN and product always within
+        # a channel, so index them together with the channel.
+        table.index_action(['channel', 'asin'], 'add')
+        table.index_action(['channel', 'fba_code'], 'add')
+        table.index_action(['channel', 'product_identifier'], 'add')
+        table.index_action(['channel', 'product'], 'add')
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        for listings, values in zip(actions, actions):
+            if set(values) & set([
+                    'channel', 'product', 'product_identifier', 'fba_code']):
+                cls._amazon_sku_cache.clear()
+                break
+        super(ProductSaleChannelListing, cls).write(*args)
+
+    @classmethod
+    def delete(cls, listings):
+        cls._amazon_sku_cache.clear()
+        super(ProductSaleChannelListing, cls).delete(listings)
+
+    @classmethod
+    def find_using_amazon_sku(cls, channel, sku):
+        """
+        Find the listing of the channel for the seller SKU. The SKU is
+        matched against the product identifier and then the FBA code of the
+        listings which have a product.
+
+        Results are cached for the process and the cache is cleared when
+        listings are changed or deleted.
+
+        :param channel: Active record of amazon channel
+        :param sku: Seller SKU from amazon
+        :returns: Tuple of (listing id, product id) or None if not found
+        """
+        key = (channel.id, sku)
+        result = cls._amazon_sku_cache.get(key)
+        if result is not None:
+            return result
+
+        listings = cls.search([
+            ('channel', '=', channel.id),
+            ('product_identifier', '=', sku),
+            ('product', '!=', None),
+        ], limit=1)
+        if not listings:
+            listings = cls.search([
+                ('channel', '=', channel.id),
+                ('fba_code', '=', sku),
+                ('product', '!=', None),
+            ], limit=1)
+        if not listings:
+            return None
+
+        listing, = listings
+        result = (listing.id, listing.product.id)
+        cls._amazon_sku_cache.set(key, result)
+        return result
+
+    @staticmethod
+    def get_amazon_price_fingerprint(price, currency_code):
+        """
+        Return the fingerprint of the price exported for a listing, which
+        is compared on the next export to find if the price changed.
+        """
+        return '%s %s' % (price, currency_code)
+
     def export_inventory(self):
         """
         Export inventory of this listing to external channel
@@ -196,48 +382,231 @@ class ProductSaleChannelListing:
     def export_bulk_inventory(cls, listings):
         """
         bulk export inventory to amazon
+
+        Only the listings marked dirty by stock moves are exported to
+        amazon, unless `force_amazon_inventory_export` is set in context.
         """
         if not listings:
             # Nothing to update
             return
 
-        non_amazon_listings = cls.search([
-            ('id', 'in', map(int, listings)),
-            ('channel.source', '!=', 'amazon_mws'),
-        ])
+        Product = Pool().get('product.product')
+
+        force = Transaction().context.get('force_amazon_inventory_export')
+
+        amazon_listings, non_amazon_listings = [], []
+        flat_file_listings = defaultdict(list)
+        for listing in listings:
+            if listing.channel.source != 'amazon_mws':
+                non_amazon_listings.append(listing)
+            elif not force and not listing.amazon_inventory_dirty:
+                continue
+            elif listing.channel.amazon_export_mode == 'flat_file':
+                flat_file_listings[listing.channel].append(listing.id)
+            else:
+                amazon_listings.append(listing)
         if non_amazon_listings:
             super(ProductSaleChannelListing, cls).export_bulk_inventory(
                 non_amazon_listings
             )
-        amazon_listings = filter(
-            lambda l: l not in non_amazon_listings, listings
+
+        # Quantities of channels in flat file mode go out with the prices
+        for channel, listing_ids in flat_file_listings.iteritems():
+            channel.export_amazon_price_and_quantity(
+                listing_ids=listing_ids, force=force
+            )
+
+        quantities = cls.get_amazon_inventory_quantities(amazon_listings)
+        products = Product.browse(
+            list(set(listing.product.id for listing in amazon_listings))
+        )
+        delivery_times = dict(
+            (product.id, product.delivery_time) for product in products
         )
 
-        inventory_channel_map = defaultdict(list)
+        # Inventory rows of the messages grouped by channel
+        rows_by_channel = defaultdict(list)
         for listing in amazon_listings:
-            product = listing.product
-            channel = listing.channel
-
-            # group inventory xml by channel
-            inventory_channel_map[channel].append(E.Message(
-                E.MessageID(str(product.id)),
-                E.OperationType('Update'),
-                E.Inventory(
-                    E.SKU(listing.product_identifier),
-                    E.Quantity("%d" % round(listing.quantity)),
-                    E.FulfillmentLatency(
-                        "%d" % max(product.delivery_time, 1)
-                    ),
-                )
+            product_id = listing.product.id
+            rows_by_channel[listing.channel].append((
+                product_id, listing.product_identifier,
+                quantities[listing.id], delivery_times[product_id], listing,
             ))
+        if not rows_by_channel:
+            return
 
-        for channel, elements in inventory_channel_map.iteritems():
-            envelope_xml = channel._get_amazon_envelop('Inventory', elements)
+        channels = rows_by_channel.keys()
+        feed_type = '_POST_INVENTORY_AVAILABILITY_DATA_'
+
+        # Channels are served by their own thread, so that the export takes
+        # as long as the slowest channel. The threads only write and upload
+        # the feeds, the database is used in this thread only.
+        pool = ThreadPool(min(len(channels), cls._amazon_export_threads))
+        feed_files = []
+        try:
+            try:
+                feed_files = pool.map(_write_amazon_inventory_feed, [
+                    (channel.get_amazon_feed_writer('Inventory'),
+                        rows_by_channel[channel])
+                    for channel in channels
+                ])
+                submissions = [
+                    channel.prepare_amazon_feeds(channel_feed_files, feed_type)
+                    for channel, channel_feed_files in zip(
+                        channels, feed_files
+                    )
+                ]
+                errors = pool.map(_upload_amazon_feeds, [
+                    (channel.upload_amazon_feeds,
+                        channel.get_amazon_feed_api(),
+                        channel.amazon_marketplace_id, channel_submissions,
+                        feed_type)
+                    for channel, channel_submissions in zip(
+                        channels, submissions
+                    )
+                ])
+            finally:
+                pool.close()
+                pool.join()
+
+            for channel, channel_submissions, error in zip(
+                    channels, submissions, errors):
+                if error is not None:
+                    # Listings of the feeds which were not sent stay dirty
+                    # and are exported again on the next run
+                    logger.warning(
+                        'Inventory export of channel %s failed: %s' % (
+                            channel.rec_name, error
+                        )
+                    )
+                feeds = channel.record_amazon_feeds(channel_submissions)
+                exported_listings = [
+                    message.origin
+                    for feed in feeds for message in feed.messages
+                    if message.origin
+                ]
+                if exported_listings:
+                    cls.write(exported_listings, {
+                        'amazon_inventory_dirty': False,
+                    })
+        finally:
+            for channel_feed_files in feed_files:
+                for feed_file in channel_feed_files:
+                    feed_file.close()
 
-            feeds_api = channel.get_amazon_feed_api()
+    @classmethod
+    def get_amazon_inventory_quantities(cls, listings):
+        """
+        Return the quantity in the warehouse of the channel for each of the
+        listings. The quantities are computed once per warehouse for all
+        the products of the listings.
 
-            feeds_api.submit_feed(
-                etree.tostring(envelope_xml),
-                feed_type='_POST_INVENTORY_AVAILABILITY_DATA_',
-                marketplaceids=[channel.amazon_marketplace_id]
+        :param listings: List of active records of listings
+        :returns: Dictionary of listing id => quantity
+        """
+        Product = Pool().get('product.product')
+        Date = Pool().get('ir.date')
+
+        product_ids_by_warehouse = defaultdict(set)
+        for listing in listings:
+            product_ids_by_warehouse[listing.channel.warehouse.id].add(
+                listing.product.id
             )
+
+        # (warehouse id, product id) => quantity
+        quantities = {}
+        with Transaction().set_context(stock_date_end=Date.today()):
+            for warehouse_id, product_ids in \
+                    product_ids_by_warehouse.iteritems():
+                quantities.update(Product.products_by_location(
+                    [warehouse_id], product_ids=list(product_ids),
+                    with_childs=True
+                ))
+
+        return dict(
+            (listing.id, quantities.get(
+                (listing.channel.warehouse.id, listing.product.id), 0
+            )) for listing in listings
+        )
+
+    @classmethod
+    def handle_amazon_feed_errors(cls, feed, listings):
+        """
+        Called when amazon failed to process the messages of the listings
+        in a feed. The listings are marked so that they are sent again on
+        the next export.
+
+        :param feed: Active record of amazon.mws.feed
+        :param listings: List of active records of listings which failed
+        """
+        if feed.feed_type == '_POST_PRODUCT_PRICING_DATA_':
+            cls.write(listings, {'amazon_price_fingerprint': None})
+        elif feed.feed_type == '_POST_INVENTORY_AVAILABILITY_DATA_':
+            cls.write(listings, {'amazon_inventory_dirty': True})
+        elif feed.feed_type == \
+                '_POST_FLAT_FILE_PRICEANDQUANTITYONLY_UPDATE_DATA_':
+            cls.write(listings, {
+                'amazon_price_fingerprint': None,
+                'amazon_inventory_dirty': True,
+            })
+
+    @classmethod
+    def export_amazon_inventory_using_cron(cls):
+        """
+        Cron method to export inventory of the dirty listings of all amazon
+        channels
+        """
+        listings = cls.search([
+            ('channel.source', '=', 'amazon_mws'),
+            ('amazon_inventory_dirty', '=', True),
+        ])
+        cls.export_bulk_inventory(listings)
+
+    @classmethod
+    def mark_amazon_inventory_dirty(cls, moves):
+        """
+        Mark the listings of amazon channels whose stock is affected by the
+        given moves as dirty, so that their inventory is exported again.
+
+        :param moves: List of active records of stock moves
+        """
+        Channel = Pool().get('sale.channel')
+        Location = Pool().get('stock.location')
+
+        if not moves:
+            return
+
+        channels = Channel.search([('source', '=', 'amazon_mws')])
+        if not channels:
+            return
+
+        products_by_location = defaultdict(set)
+        for move in moves:
+            products_by_location[move.from_location.id].add(move.product.id)
+            products_by_location[move.to_location.id].add(move.product.id)
+
+        # Warehouse => Locations of the moves inside it
+        locations_by_warehouse = {}
+        dirty_listings = []
+        for channel in channels:
+            product_ids = set()
+            for warehouse in filter(
+                    None, [channel.warehouse, channel.fba_warehouse]):
+                if warehouse.id not in locations_by_warehouse:
+                    locations_by_warehouse[warehouse.id] = Location.search([
+                        ('id', 'in', products_by_location.keys()),
+                        ('parent', 'child_of', [warehouse.id]),
+                    ])
+                for location in locations_by_warehouse[warehouse.id]:
+                    product_ids.update(products_by_location[location.id])
+            if not product_ids:
+                continue
+
+            dirty_listings.extend(cls.search([
+                ('channel', '=', channel.id),
+                ('product', 'in', list(product_ids)),
+                ('amazon_inventory_dirty', '=', False),
+            ]))
+
+        if dirty_listings:
+            cls.write(dirty_listings, {'amazon_inventory_dirty': True})
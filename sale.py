@@ -5,17 +5,28 @@
     Sale
 
 """
+import logging
 import dateutil.parser
 from decimal import Decimal
+from multiprocessing.pool import ThreadPool
 
+from sql import For
+
+from trytond import backend
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pyson import Eval
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
 from trytond.exceptions import UserError
 
+from channel import batch
+
 
-__all__ = ['Sale']
+__all__ = ['Sale', 'AmazonOrderQueue']
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger("amazon_mws")
+
 
 class Sale:
     "Sale"
@@ -67,84 +78,159 @@ class Sale:
         :param order_data: Order data from amazon
         :return: Active record of record created
         """
+        sale, = cls.create_many_using_amazon_data([(order_data, line_data)])
+        return sale
+
+    @classmethod
+    def create_many_using_amazon_data(cls, orders_data, enqueue=False):
+        """
+        Create sales for a page of amazon orders. The sales and their lines
+        are created with a single create call and the total of each order
+        is checked with the line data before anything is processed.
+
+        :param orders_data: List of (order data, line data) from amazon
+        :param enqueue: If True, the sales are put in the order queue to be
+                        processed by its workers instead of being processed
+                        now
+        :return: List of active records of sales created, in the same order
+                 as orders_data
+        """
         Party = Pool().get('party.party')
         Address = Pool().get('party.address')
         SaleChannel = Pool().get('sale.channel')
         ChannelException = Pool().get('channel.exception')
+        OrderQueue = Pool().get('amazon.mws.order_queue')
 
         amazon_channel = SaleChannel(
             Transaction().context['current_channel']
         )
         assert amazon_channel.source == 'amazon_mws'
 
-        party_values = {
-            'name': order_data['BuyerName']['value'],
-            'email': order_data['BuyerEmail']['value'],
-        }
-        party = Party.find_or_create_using_amazon_data(party_values)
-        if 'Phone' in order_data.get('ShippingAddress', {}):
-            party.add_phone_using_amazon_data(
-                order_data['ShippingAddress']['Phone']['value']
-            )
-        party_invoice_address = party_shipping_address = \
-            Address.find_or_create_for_party_using_amazon_data(
-                party, order_data.get('ShippingAddress', None)
-            )
-
-        sale = cls.get_sale_using_amazon_data(order_data, line_data)
+        sales = []
+        for order_data, line_data in orders_data:
+            party_values = {
+                'name': order_data['BuyerName']['value'],
+                'email': order_data['BuyerEmail']['value'],
+            }
+            party = Party.find_or_create_using_amazon_data(party_values)
+            if 'Phone' in order_data.get('ShippingAddress', {}):
+                party.add_phone_using_amazon_data(
+                    order_data['ShippingAddress']['Phone']['value']
+                )
+            party_invoice_address = party_shipping_address = \
+                Address.find_or_create_for_party_using_amazon_data(
+                    party, order_data.get('ShippingAddress', None)
+                )
 
-        sale.party = party.id
-        sale.invoice_address = party_invoice_address.id
-        sale.shipment_address = party_shipping_address.id
-        sale.channel = amazon_channel.id
+            sale = cls.get_sale_using_amazon_data(order_data, line_data)
 
-        if order_data['FulfillmentChannel']['value'] == 'AFN':
-            sale.warehouse = amazon_channel.fba_warehouse.id
-            for line in sale.lines:
-                # Set warehouse explicitly else it default is set
-                # to channel.warehouse
-                line.warehouse = sale.warehouse
-            sale.invoice_method = 'manual'
-            sale.shipment_method = 'order'
+            sale.party = party.id
+            sale.invoice_address = party_invoice_address.id
+            sale.shipment_address = party_shipping_address.id
+            sale.channel = amazon_channel.id
 
-        sale.save()
+            if order_data['FulfillmentChannel']['value'] == 'AFN':
+                sale.warehouse = amazon_channel.fba_warehouse.id
+                for line in sale.lines:
+                    # Set warehouse explicitly else it default is set
+                    # to channel.warehouse
+                    line.warehouse = sale.warehouse
+                sale.invoice_method = 'manual'
+                sale.shipment_method = 'order'
+            sales.append(sale)
 
         # TODO: Handle Discounts
         # TODO: Handle Taxes
 
-        if sale.total_amount != Decimal(
-            order_data['OrderTotal']['Amount']['value']
-        ):
+        # Total of the lines is known before saving, so it is not read back
+        totals = [cls.get_amazon_sale_total(new_sale) for new_sale in sales]
+
+        sales = cls.create([new_sale._save_values for new_sale in sales])
+
+        mismatched_sales = []
+        orders_to_process = []
+        for sale, total, (order_data, _) in zip(sales, totals, orders_data):
+            if total != Decimal(order_data['OrderTotal']['Amount']['value']):
+                mismatched_sales.append(sale)
+                continue
+            orders_to_process.append((
+                sale, order_data['OrderStatus']['value'],
+                order_data['FulfillmentChannel']['value'],
+            ))
+
+        if mismatched_sales:
             ChannelException.create([{
                 'origin': '%s,%s' % (sale.__name__, sale.id),
                 'log': 'Order total does not match.',
                 'channel': sale.channel.id,
-            }])
+            } for sale in mismatched_sales])
 
-            return sale
-
-        # Process sale now
-        tryton_action = amazon_channel.get_tryton_action(
-            order_data['OrderStatus']['value']
-        )
-        try:
-            if order_data['FulfillmentChannel']['value'] == 'MFN':
-                sale.process_to_channel_state(order_data['OrderStatus']['value'])  # noqa
-            elif order_data['FulfillmentChannel']['value'] == 'AFN':
-                sale.process_fba_order()
-        except UserError, e:
-            # Expecting UserError will only come when sale order has
-            # channel exception.
-            # Just ignore the error and leave this order in draft state
-            # and let the user fix this manually.
-            ChannelException.create([{
-                'origin': '%s,%s' % (sale.__name__, sale.id),
-                'log': "Error occurred on transitioning to state %s.\nError "
-                "Message: %s" % (tryton_action['action'], e.message),
+        if enqueue:
+            OrderQueue.create([{
                 'channel': sale.channel.id,
-            }])
+                'sale': sale.id,
+                'order_status': order_status,
+                'fulfillment_channel': fulfillment_channel,
+            } for sale, order_status, fulfillment_channel
+                in orders_to_process])
+        else:
+            cls.process_amazon_orders(orders_to_process)
 
-        return sale
+        return sales
+
+    @classmethod
+    def process_amazon_orders(cls, orders):
+        """
+        Move the sales of amazon orders to the state of the order on
+        amazon. FBA orders are processed together as past orders.
+
+        The orders which fail are left as they are with a channel exception,
+        except FBA orders processed together whose failure is raised, see
+        `process_fba_orders`.
+
+        :param orders: List of (sale, amazon order status, fulfillment
+                       channel of the order)
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        fba_sales = []
+        for sale, order_status, fulfillment_channel in orders:
+            if fulfillment_channel == 'AFN':
+                fba_sales.append(sale)
+                continue
+
+            tryton_action = sale.channel.get_tryton_action(order_status)
+            try:
+                sale.process_to_channel_state(order_status)
+            except UserError, e:
+                # Expecting UserError will only come when sale order has
+                # channel exception.
+                # Just ignore the error and leave this order in draft state
+                # and let the user fix this manually.
+                ChannelException.create([{
+                    'origin': '%s,%s' % (sale.__name__, sale.id),
+                    'log': "Error occurred on transitioning to state %s.\n"
+                    "Error Message: %s" % (tryton_action['action'], e.message),
+                    'channel': sale.channel.id,
+                }])
+
+        cls.process_fba_orders(fba_sales)
+
+    @staticmethod
+    def get_amazon_sale_total(sale):
+        """
+        Return the total of the lines of the sale which is not saved yet,
+        computed the same way as the amount of the lines.
+
+        :param sale: Instance of sale with its lines
+        """
+        currency = sale.currency
+        return sum(
+            (currency.round(
+                Decimal(str(line.quantity)) * Decimal(line.unit_price)
+            ) for line in sale.lines),
+            Decimal('0')
+        )
 
     @classmethod
     def get_sale_using_amazon_data(cls, order_data, line_data):
@@ -278,60 +364,308 @@ class Sale:
             quantity=1
         )
 
+    @classmethod
+    def handle_amazon_feed_errors(cls, feed, sales):
+        """
+        Called when amazon failed to process the messages of the sales in
+        a feed. An exception is logged on the channel for each sale.
+
+        :param feed: Active record of amazon.mws.feed
+        :param sales: List of active records of sales which failed
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        ChannelException.create([{
+            'origin': '%s,%s' % (sale.__name__, sale.id),
+            'log': 'Amazon failed to process feed %s of type %s.' % (
+                feed.submission_id, feed.feed_type
+            ),
+            'channel': sale.channel.id,
+        } for sale in sales])
+
     def update_order_status_from_amazon_mws(self, order_data=None):
         """Update order status from amazon mws
 
         :TODO: this only handles shipped orders of amazon mws. Should handle
         other states too?
         """
-        Shipment = Pool().get('stock.shipment.out')
-
         if order_data is None:
             order_api = self.channel.get_amazon_order_api()
             order_data = order_api.get_order(
                 [self.channel_identifier]
             ).parsed['Orders']['Order']
 
-        if order_data['OrderStatus']['value'] == "Canceled":
-            # TODO
-            # If not done
-            # - cancel shipment
-            # - cancel invoice or credit invoice
-            pass
-
-        if order_data['OrderStatus']['value'] == "Shipped":
-            # Order is completed on amazon, process shipments and
-            # invoices.
-            for shipment in self.shipments:
-                if shipment.state == 'draft':
-                    Shipment.wait([shipment])
-                if shipment.state == 'waiting':
-                    Shipment.assign([shipment])
-                if shipment.state == 'assigned':
-                    Shipment.pack([shipment])
-                if shipment.state == 'packed':
-                    Shipment.done([shipment])
-
-            # TODO: handle invoices?
+        self.update_orders_status_from_amazon_mws([(self, order_data)])
+
+    @classmethod
+    def update_orders_status_from_amazon_mws(cls, sales_data):
+        """
+        Update status of many orders from amazon mws. The shipments of all
+        the shipped orders are completed together.
+
+        :param sales_data: List of (sale, order data from amazon)
+        """
+        shipments = []
+        for sale, order_data in sales_data:
+            if order_data['OrderStatus']['value'] == "Canceled":
+                # TODO
+                # If not done
+                # - cancel shipment
+                # - cancel invoice or credit invoice
+                pass
+
+            if order_data['OrderStatus']['value'] == "Shipped":
+                # Order is completed on amazon, process shipments and
+                # invoices.
+                shipments.extend(sale.shipments)
+
+        cls.complete_amazon_shipments(shipments)
+
+        # TODO: handle invoices?
+
+    @classmethod
+    def complete_amazon_shipments(cls, shipments):
+        """
+        Take the shipments of amazon orders to done, one workflow
+        transition at a time for all of them.
+
+        :param shipments: List of active records of shipments
+        """
+        Shipment = Pool().get('stock.shipment.out')
+
+        for transition, from_state in (
+                (Shipment.wait, 'draft'),
+                (Shipment.assign, 'waiting'),
+                (Shipment.pack, 'assigned'),
+                (Shipment.done, 'packed')):
+            to_transition = [
+                shipment for shipment in shipments
+                if shipment.state == from_state
+            ]
+            if to_transition:
+                transition(to_transition)
 
     def process_fba_order(self):
         """
         Process FBA Orders as they are imported as past orders
         and handle their shipments.
         """
+        self._process_fba_orders([self])
+
+    @classmethod
+    def _process_fba_orders(cls, sales):
+        """
+        Process the FBA orders and complete their shipments, each workflow
+        transition is done for all the sales at once.
+        """
+        for transition, from_state in (
+                (cls.quote, 'draft'),
+                (cls.confirm, 'quotation'),
+                (cls.process, 'confirmed')):
+            to_transition = [
+                sale for sale in sales if sale.state == from_state
+            ]
+            if to_transition:
+                transition(to_transition)
+
+        cls.complete_amazon_shipments([
+            shipment for sale in sales for shipment in sale.shipments
+        ])
+
+    @classmethod
+    def process_fba_orders(cls, sales):
+        """
+        Process the FBA orders imported together, each workflow transition
+        is done for all of them at once.
+
+        A failure is raised and nothing done for the other orders is
+        undone, so the caller has to roll back the transaction and process
+        the orders one at a time, as the order queue does. A single order
+        which fails is left as it is with a channel exception.
+
+        :param sales: List of active records of sales
+        """
+        ChannelException = Pool().get('channel.exception')
+
+        if not sales:
+            return
+
+        if len(sales) > 1:
+            cls._process_fba_orders(sales)
+            return
+
+        sale, = sales
+        try:
+            cls._process_fba_orders([sale])
+        except UserError, e:
+            ChannelException.create([{
+                'origin': '%s,%s' % (sale.__name__, sale.id),
+                'log': "Error occurred on processing FBA order.\n"
+                "Error Message: %s" % e.message,
+                'channel': sale.channel.id,
+            }])
+
+
+class AmazonOrderQueue(ModelSQL, ModelView):
+    """
+    Amazon Order Queue
+
+    Sales imported from amazon waiting to be moved to the state of the
+    order on amazon. The queue is processed by a pool of workers, each in
+    its own transaction, so that importing orders does not wait for the
+    invoices and shipments of the orders to be created.
+    """
+    __name__ = 'amazon.mws.order_queue'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True, select=True
+    )
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, readonly=True)
+    order_status = fields.Char('Amazon Order Status', readonly=True)
+    fulfillment_channel = fields.Selection([
+        ('MFN', 'Fulfilled by Merchant'),
+        ('AFN', 'Fulfilled by Amazon'),
+    ], 'Fulfillment Channel', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True, states={
+        'invisible': Eval('state') != 'failed',
+    }, depends=['state'])
+
+    #: Number of workers processing the queue at once
+    _max_workers = 4
+
+    #: Number of orders given to a worker at a time
+    _batch_size = 50
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def get_rec_name(self, name):
+        return self.sale.rec_name
+
+    @classmethod
+    def process_using_cron(cls):
+        """
+        Cron method to process the pending orders with the worker pool
+        """
+        transaction = Transaction()
+
+        ids = map(int, cls.search(
+            [('state', '=', 'pending')], order=[('id', 'ASC')]
+        ))
+        if not ids:
+            return
+
+        # Workers start their own transaction, they only get the ids
+        pool = ThreadPool(cls._max_workers)
+        try:
+            pool.map(_process_amazon_orders, [
+                (transaction.cursor.database_name, transaction.user,
+                    transaction.context, chunk)
+                for chunk in batch(ids, cls._batch_size)
+            ])
+        finally:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def lock_pending(cls, ids):
+        """
+        Lock the rows of the entries which are still pending. The lock is
+        held until the end of the transaction, so the entries are not
+        processed by two workers.
+
+        Raises DatabaseOperationalError if another transaction holds the
+        lock of one of the entries.
+
+        :param ids: List of ids of entries
+        :returns: List of active records of the entries locked
+        """
+        table = cls.__table__()
+        cursor = Transaction().cursor
+
+        query = table.select(
+            table.id,
+            where=table.id.in_(ids) & (table.state == 'pending')
+        )
+        if backend.name() == 'postgresql':
+            # SQLite locks the whole database on write, row locks are only
+            # available on postgres
+            query.for_ = For('UPDATE', nowait=True)
+        cursor.execute(*query)
+        return cls.browse([row[0] for row in cursor.fetchall()])
+
+    @classmethod
+    def process(cls, entries):
+        """
+        Process the sales of the entries and mark them as done.
+
+        :param entries: List of active records of entries
+        """
         Sale = Pool().get('sale.sale')
-        Shipment = Pool().get('stock.shipment.out')
 
-        Sale.quote([self])
-        Sale.confirm([self])
-        Sale.process([self])
-
-        for shipment in self.shipments:
-            if shipment.state == 'draft':
-                Shipment.wait([shipment])
-            if shipment.state == 'waiting':
-                Shipment.assign([shipment])
-            if shipment.state == 'assigned':
-                Shipment.pack([shipment])
-            if shipment.state == 'packed':
-                Shipment.done([shipment])
+        entries = [entry for entry in entries if entry.state == 'pending']
+        if not entries:
+            return
+
+        Sale.process_amazon_orders([
+            (entry.sale, entry.order_status, entry.fulfillment_channel)
+            for entry in entries
+        ])
+        cls.write(entries, {'state': 'done'})
+
+    @classmethod
+    def process_batch(cls, ids):
+        """
+        Process the entries together and commit the transaction once. If that
+        fails, the transaction is rolled back and each entry is processed and
+        committed on its own, skipping entries locked by another worker. An
+        entry which fails on its own is marked as failed.
+
+        :param ids: List of ids of entries
+        """
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        cursor = Transaction().cursor
+
+        try:
+            cls.process(cls.lock_pending(ids))
+            cursor.commit()
+            return
+        except Exception:
+            cursor.rollback()
+
+        for entry_id in ids:
+            try:
+                cls.process(cls.lock_pending([entry_id]))
+                cursor.commit()
+            except DatabaseOperationalError:
+                # Being processed by another worker
+                cursor.rollback()
+            except Exception, e:
+                logger.exception(
+                    'Failed to process amazon order queue entry %s' % entry_id
+                )
+                cursor.rollback()
+                cls.write([cls(entry_id)], {
+                    'state': 'failed',
+                    'error': repr(e),
+                })
+                cursor.commit()
+
+
+def _process_amazon_orders(args):
+    """
+    Process a batch of queued amazon orders in a transaction of this thread.
+
+    :param args: Tuple of (database name, user id, context, list of ids of
+                 queue entries)
+    """
+    database_name, user, context, ids = args
+
+    with Transaction().start(database_name, user, context=context):
+        Pool().get('amazon.mws.order_queue').process_batch(ids)
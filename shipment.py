@@ -2,22 +2,34 @@
 """
     shipment.py
 """
+import logging
+from copy import deepcopy
 from collections import defaultdict
-from lxml.builder import E
+from multiprocessing.pool import ThreadPool
 from lxml import etree
+from lxml.builder import E
+from mws import mws
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval, PYSONEncoder
-from trytond.model import ModelView, fields, Workflow
-from trytond.wizard import Wizard, StateAction, StateView, Button
+from trytond.transaction import Transaction
+from trytond.model import ModelSQL, ModelView, fields, Workflow
+from trytond.wizard import Wizard, StateAction, StateView, \
+    StateTransition, Button
+from trytond.exceptions import UserError
+
+from channel import batch
 
 
 __all__ = [
-    'ShipmentOut', 'StockLocation', 'ShipmentInternal',
+    'StockMove', 'ShipmentOut', 'StockLocation', 'ShipmentInternal',
     'InboundShipmentProducts', 'InboundShipmentCreateStart',
-    'InboundShipmentCreate'
+    'InboundShipmentCreate', 'AmazonFulfillment', 'InboundShipmentRequest',
+    'InboundShipmentRequestLine'
 ]
 __metaclass__ = PoolMeta
 
+logger = logging.getLogger("amazon_mws")
+
 
 class StockLocation:
     __name__ = 'stock.location'
@@ -25,21 +37,54 @@ class StockLocation:
     # This field is added so we can have sku of the product (fullfilled by
     # amazon) while sending product info to amazon network
     fba_channel = fields.Function(
-        fields.Many2One("sale.channel", "Channel"),
-        'on_change_with_fba_channel',
+        fields.Many2One("sale.channel", "Channel"), 'get_fba_channel'
     )
 
+    @classmethod
+    def get_fba_channel(cls, locations, name):
+        Channel = Pool().get('sale.channel')
+
+        channels = Channel.get_fba_warehouse_channels()
+        return dict(
+            (location.id, location.parent and channels.get(location.parent.id))
+            for location in locations
+        )
+
     @fields.depends('parent')
     def on_change_with_fba_channel(self, name=None):
         Channel = Pool().get('sale.channel')
 
         if self.parent:
-            channel = Channel.search([
-                ('source', '=', 'amazon_mws'),
-                ('fba_warehouse', '=', self.parent.id),
-            ])
+            return Channel.get_fba_warehouse_channels().get(self.parent.id)
+
 
-            return channel and channel[0].id or None
+class StockMove:
+    "Stock Move"
+    __name__ = 'stock.move'
+
+    amazon_sku = fields.Char('Amazon SKU', readonly=True)
+    amazon_quantity_received = fields.Float(
+        'Quantity Received by Amazon', readonly=True,
+        digits=(16, Eval('unit_digits', 2)), depends=['unit_digits']
+    )
+
+    @classmethod
+    def assign(cls, moves):
+        super(StockMove, cls).assign(moves)
+        Pool().get('product.product.channel_listing').\
+            mark_amazon_inventory_dirty(moves)
+
+    @classmethod
+    def do(cls, moves):
+        super(StockMove, cls).do(moves)
+        Pool().get('product.product.channel_listing').\
+            mark_amazon_inventory_dirty(moves)
+
+    @classmethod
+    def cancel(cls, moves):
+        super(StockMove, cls).cancel(moves)
+        Pool().get('product.product.channel_listing').\
+            mark_amazon_inventory_dirty(moves)
 
 
 class ShipmentOut:
@@ -48,10 +93,13 @@ class ShipmentOut:
 
     def export_shipment_status_to_amazon(self):
         """
-        TODO: This should be done in bulk to avoid over using the amazon
-        API.
+        Queue the fulfillment of the amazon sales of this shipment. The
+        queued fulfillments are sent to amazon together per channel, see
+        amazon.mws.fulfillment.
         """
         SaleLine = Pool().get('sale.line')
+        Fulfillment = Pool().get('amazon.mws.fulfillment')
+
         if self.state != 'done':
             return
 
@@ -108,27 +156,173 @@ class ShipmentOut:
                 )
             )
 
-        # For each sale, now export the data
+        # For each sale, now queue the data
+        fulfillment_values = []
         for sale, items in items_by_sale.items():
-            message = E.Message(
-                E.MessageID(str(sale.id)),  # just has to be unique in envelope
-                E.OrderFulfillment(
-                    E.AmazonOrderID(sale.channel_identifier),
-                    E.FulfillmentDate(
-                        self.write_date.strftime('%Y-%m-%dT00:00:00Z')
-                    ),
-                    fulfilment_data,
-                    *items
-                )
+            order_fulfillment = E.OrderFulfillment(
+                E.AmazonOrderID(sale.channel_identifier),
+                E.FulfillmentDate(
+                    self.write_date.strftime('%Y-%m-%dT00:00:00Z')
+                ),
+                deepcopy(fulfilment_data),
+                *items
             )
-            envelope_xml = sale.channel._get_amazon_envelop(
-                'OrderFulfillment', [message]
+            fulfillment_values.append({
+                'channel': sale.channel.id,
+                'sale': sale.id,
+                'shipment': self.id,
+                'message': etree.tostring(order_fulfillment),
+            })
+
+        fulfillments = Fulfillment.create(fulfillment_values)
+        Fulfillment.submit_if_batch_full(
+            list(set(f.channel for f in fulfillments))
+        )
+
+
+class AmazonFulfillment(ModelSQL, ModelView):
+    """
+    Amazon Order Fulfillment
+
+    Outbox of order fulfillment messages. The queued messages are sent
+    together in a single feed per channel, on a schedule or as soon as
+    the batch size of the channel is reached.
+    """
+    __name__ = 'amazon.mws.fulfillment'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True, select=True
+    )
+    sale = fields.Many2One('sale.sale', 'Sale', required=True, readonly=True)
+    shipment = fields.Many2One(
+        'stock.shipment.out', 'Shipment', readonly=True
+    )
+    message = fields.Text('OrderFulfillment Message', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('submitted', 'Submitted'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+
+    #: Number of times a fulfillment is submitted before giving up
+    _max_attempts = 3
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    def get_rec_name(self, name):
+        return self.sale.rec_name
+
+    @classmethod
+    def submit_using_cron(cls):
+        """
+        Cron method to submit all queued fulfillments
+        """
+        cls.submit(cls.search([('state', '=', 'pending')]))
+
+    @classmethod
+    def submit_if_batch_full(cls, channels):
+        """
+        Submit the queued fulfillments of the channels which have at least
+        as many queued fulfillments as the batch size of the channel.
+
+        :param channels: List of active records of channels
+        """
+        for channel in channels:
+            fulfillments = cls.search([
+                ('channel', '=', channel.id),
+                ('state', '=', 'pending'),
+            ])
+            if len(fulfillments) >= channel.amazon_fulfillment_batch_size:
+                cls.submit(fulfillments)
+
+    @classmethod
+    def submit(cls, fulfillments):
+        """
+        Send the fulfillments to amazon, in one envelope per channel.
+
+        :param fulfillments: List of active records of fulfillments
+        """
+        fulfillments_by_channel = defaultdict(list)
+        for fulfillment in fulfillments:
+            if fulfillment.state != 'pending':
+                continue
+            fulfillments_by_channel[fulfillment.channel].append(fulfillment)
+
+        for channel, channel_fulfillments in \
+                fulfillments_by_channel.iteritems():
+            with channel.get_amazon_feed_writer(
+                    'OrderFulfillment') as writer:
+                for fulfillment in channel_fulfillments:
+                    writer.write(E.Message(
+                        E.MessageID(str(fulfillment.id)),
+                        etree.fromstring(fulfillment.message),
+                    ), origin=fulfillment)
+            submissions = channel.prepare_amazon_feeds(
+                writer.feeds, '_POST_ORDER_FULFILLMENT_DATA_'
             )
-            feeds_api = sale.channel.get_amazon_feed_api()
-            feeds_api.submit_feed(
-                etree.tostring(envelope_xml),
-                feed_type='_POST_ORDER_FULFILLMENT_DATA_',
-                marketplaceids=[sale.channel.amazon_marketplace_id]
+            try:
+                channel.upload_amazon_feeds(
+                    channel.get_amazon_feed_api(),
+                    channel.amazon_marketplace_id, submissions,
+                    '_POST_ORDER_FULFILLMENT_DATA_'
+                )
+            except mws.MWSError, e:
+                # Fulfillments of the feeds not sent are left queued, they
+                # are sent again on next run
+                logger.warning(e.message)
+
+            # Fulfillments are submitted before the feeds are recorded, the
+            # results of skipped feeds are known when they are recorded
+            submitted = [
+                fulfillment
+                for feed_file, values in submissions if 'state' in values
+                for _, fulfillment in feed_file.messages
+            ]
+            if submitted:
+                cls.write(*sum([
+                    [[fulfillment], {
+                        'state': 'submitted',
+                        'attempts': fulfillment.attempts + 1,
+                    }] for fulfillment in submitted
+                ], []))
+            channel.record_amazon_feeds(submissions)
+
+    @classmethod
+    def handle_amazon_feed_success(cls, feed, fulfillments):
+        cls.write(fulfillments, {'state': 'done'})
+
+    @classmethod
+    def handle_amazon_feed_errors(cls, feed, fulfillments):
+        """
+        Queue the failed fulfillments again, unless they already failed too
+        many times. Fulfillments of a feed cancelled by amazon are failed
+        too, so they are sent again.
+        """
+        Sale = Pool().get('sale.sale')
+
+        to_retry, failed = [], []
+        for fulfillment in fulfillments:
+            if fulfillment.state != 'submitted':
+                continue
+            if fulfillment.attempts < cls._max_attempts:
+                to_retry.append(fulfillment)
+            else:
+                failed.append(fulfillment)
+
+        if to_retry:
+            cls.write(to_retry, {'state': 'pending'})
+        if failed:
+            cls.write(failed, {'state': 'failed'})
+            Sale.handle_amazon_feed_errors(
+                feed, [fulfillment.sale for fulfillment in failed]
             )
 
 
@@ -144,36 +338,79 @@ class ShipmentInternal:
     )
 
     channel_source = fields.Function(
-        fields.Char("Channel Source"), "on_change_with_channel_source"
+        fields.Char("Channel Source"), "get_channel_source"
+    )
+
+    amazon_inbound_request = fields.Many2One(
+        'inbound_shipment.request', 'Inbound Shipment Request',
+        readonly=True
     )
 
+    @classmethod
+    def get_channel_source(cls, shipments, name):
+        Channel = Pool().get('sale.channel')
+
+        # Only amazon channels have FBA warehouses
+        channels = Channel.get_fba_warehouse_channels()
+        result = {}
+        for shipment in shipments:
+            warehouse = shipment.to_location.parent
+            result[shipment.id] = 'amazon_mws' \
+                if warehouse and warehouse.id in channels else None
+        return result
+
     @fields.depends('to_location')
     def on_change_with_channel_source(self, name=None):
-        return (
-            self.to_location.parent and self.to_location.parent.fba_channel
-        ) and self.to_location.parent.fba_channel.source or None
+        Channel = Pool().get('sale.channel')
+
+        if self.to_location and self.to_location.parent and \
+                self.to_location.parent.id in \
+                Channel.get_fba_warehouse_channels():
+            return 'amazon_mws'
+
+    @classmethod
+    def __setup__(cls):
+        super(ShipmentInternal, cls).__setup__()
+        cls._error_messages.update({
+            'inbound_shipments_not_received': (
+                'Items in these shipments have not been received by the '
+                'Amazon fulfillment center yet: %(shipments)s'
+            ),
+        })
 
     @classmethod
     @ModelView.button
     @Workflow.transition('done')
     def done(cls, shipments):
+        if Transaction().context.get('amazon_inbound_shipment_closed'):
+            return super(ShipmentInternal, cls).done(shipments)
+
+        shipments_by_channel = defaultdict(list)
         for shipment in shipments:
             if not shipment.mws_inbound_shipment_id:
                 continue
+            shipments_by_channel[shipment.to_location.fba_channel].append(
+                shipment
+            )
 
-            channel = shipment.to_location.fba_channel
+        not_received = []
+        for channel, channel_shipments in shipments_by_channel.iteritems():
             channel.validate_amazon_channel()
-            mws_connection_api = channel.get_mws_boto_connection_api()
+            statuses = channel.get_amazon_inbound_shipment_statuses([
+                shipment.mws_inbound_shipment_id
+                for shipment in channel_shipments
+            ])
+            not_received.extend([
+                shipment for shipment in channel_shipments
+                if statuses.get(shipment.mws_inbound_shipment_id) != 'CLOSED'
+            ])
 
-            # Get status for inbound shipment
-            result = mws_connection_api.list_inbound_shipments(
-                ShipmentIdList=[shipment.mws_inbound_shipment_id]
-            )
-            if result.ListInboundShipmentsResult.ShipmentData[0].ShipmentStatus != 'CLOSED':  # noqa
-                cls.raise_user_error(
-                    "Items in this shipments has not been received by "
-                    "the Amazon fulfillment center yet."
-                )
+        if not_received:
+            cls.raise_user_error('inbound_shipments_not_received', {
+                'shipments': ', '.join(
+                    shipment.rec_name for shipment in not_received
+                ),
+            })
         return super(ShipmentInternal, cls).done(shipments)
 
 
@@ -204,149 +441,244 @@ class InboundShipmentCreateStart(ModelView):
     )
 
 
-class InboundShipmentCreate(Wizard):
-    "Create Inbound Shipment"
-    __name__ = "inbound_shipment.create"
+class InboundShipmentRequest(ModelSQL, ModelView):
+    """
+    Inbound Shipment Request
 
-    start = StateView(
-        'inbound_shipment.create.start',
-        'amazon_mws.inbound_shipment_create_start_form',
-        [
-            Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Create', 'create_', 'tryton-go-next', default=True),
-        ]
+    Products to send to an amazon fulfillment center. Large requests are
+    not sent from the wizard but by a cron, the request is the handle to
+    follow them.
+    """
+    __name__ = 'inbound_shipment.request'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True
+    )
+    from_location = fields.Many2One(
+        'stock.location', 'From Location', required=True, readonly=True
+    )
+    to_location = fields.Many2One(
+        'stock.location', 'To Location', required=True, readonly=True
+    )
+    lines = fields.One2Many(
+        'inbound_shipment.request.line', 'request', 'Lines', readonly=True
+    )
+    shipments = fields.One2Many(
+        'stock.shipment.internal', 'amazon_inbound_request', 'Shipments',
+        readonly=True
     )
-    create_ = StateAction('stock.act_shipment_internal_form')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], 'State', required=True, readonly=True, select=True)
+    error = fields.Text('Error', readonly=True, states={
+        'invisible': Eval('state') != 'failed',
+    }, depends=['state'])
+
+    #: Number of items amazon accepts in a shipment plan request
+    _plan_items_limit = 200
+
+    #: Maximum number of requests sent to amazon at once
+    _max_threads = 4
+
+    @classmethod
+    def __setup__(cls):
+        super(InboundShipmentRequest, cls).__setup__()
+        cls._error_messages.update({
+            'warehouse_not_mapped': (
+                'Warehouse "%(warehouse)s" should be mapped to amazon '
+                'channel'
+            ),
+            'warehouse_address_missing': (
+                'Warehouse "%(warehouse)s" must have an address'
+            ),
+            'product_not_listed': (
+                'Product "%(product)s" is not listed on amazon'
+            ),
+            'sku_not_found': 'No product found for SKU "%(sku)s"',
+            'amazon_error': 'Amazon returned an error: %(error)s',
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (
+            self.from_location.rec_name, self.to_location.rec_name
+        )
 
-    def find_product_using_sku(self, sku, channel):
+    @classmethod
+    def process_using_cron(cls):
         """
-        Search product with given sku and channel
+        Cron method to send the pending requests to amazon
         """
-        Listing = Pool().get('product.product.channel_listing')
+        for request in cls.search([('state', '=', 'pending')]):
+            try:
+                shipments = cls.create_inbound_shipments(
+                    request.channel, request.from_location,
+                    request.to_location,
+                    [(line.product, line.quantity) for line in request.lines]
+                )
+            except UserError, e:
+                cls.write([request], {
+                    'state': 'failed',
+                    'error': e.message,
+                })
+                continue
+            cls.write([request], {
+                'state': 'done',
+                'shipments': [('add', map(int, shipments))],
+            })
 
-        listings = Listing.search([
-            ('channel', '=', channel.id),
-            ['OR',
-                [
-                    ('fba_code', '=', sku)
-                ], [
-                    ('product.code', '=', sku)
-                ]
-             ]
-        ], limit=1)
+    @classmethod
+    def find_products_using_skus(cls, skus, channel):
+        """
+        Search products of the given skus and channel, with one query for
+        the listings and one for the product codes.
 
-        return listings and listings[0].product or None
+        :param skus: List of seller SKUs
+        :param channel: Active record of channel
+        :returns: Dictionary of sku => product for the skus found
+        """
+        Listing = Pool().get('product.product.channel_listing')
+        Product = Pool().get('product.product')
+
+        skus = list(set(skus))
+        products_by_sku = {}
+        for listing in Listing.search([
+                ('channel', '=', channel.id),
+                ('product', '!=', None),
+                ['OR',
+                    ('product_identifier', 'in', skus),
+                    ('fba_code', 'in', skus)]]):
+            # SKU of the product identifier wins over FBA code
+            if listing.product_identifier in skus:
+                products_by_sku[listing.product_identifier] = \
+                    listing.product
+            if listing.fba_code in skus:
+                products_by_sku.setdefault(listing.fba_code, listing.product)
+
+        missing = [sku for sku in skus if sku not in products_by_sku]
+        if missing:
+            products = Product.search([
+                ('code', 'in', missing),
+                ('channel_listings.channel', '=', channel.id),
+            ])
+            for product in products:
+                products_by_sku.setdefault(product.code, product)
+        return products_by_sku
 
-    def create_inbound_shipment(self):
+    @classmethod
+    def create_inbound_shipments(
+            cls, channel, from_location, to_location, items):
+        """
+        Create the inbound shipments on amazon for the items and the
+        internal shipments for them.
+
+        The items are split into shipment plan requests of the size amazon
+        accepts. The plans, and then the shipments of the plans, are
+        created on amazon concurrently.
+
+        :param channel: Active record of amazon channel
+        :param from_location: Active record of location the items leave
+        :param to_location: Active record of location in the FBA warehouse
+        :param items: List of (product, quantity)
+        :returns: List of active records of internal shipments
+        """
         Listing = Pool().get('product.product.channel_listing')
         Shipment = Pool().get('stock.shipment.internal')
 
-        to_location = self.start.to_location
-        from_location = self.start.from_location
-
-        channel = to_location.fba_channel
-
-        if not channel:
-            self.raise_user_error(
-                "Warehouse %s should be mapped to amazon channel" % (
-                    to_location.parent.rec_name.title()
-                )
-            )
-
         channel.validate_amazon_channel()
 
-        mws_connection_api = channel.get_mws_boto_connection_api()
-
-        from_address = self.start.from_location.parent.address
-
+        from_address = from_location.parent.address
         if not from_address:
-            self.raise_user_error(
-                "Warehouse %s must have an address" % (
-                    to_location.parent.rec_name.title()
-                )
-            )
-
+            cls.raise_user_error('warehouse_address_missing', {
+                'warehouse': from_location.parent.rec_name,
+            })
         ship_from_address = from_address.to_fba()
 
+        listings_by_product = {}
+        for listing in Listing.search([
+                ('product', 'in', [product.id for product, _ in items]),
+                ('channel', '=', channel.id)]):
+            listings_by_product.setdefault(listing.product.id, listing)
+
         fba_products = []
-        for inbound_product in self.start.products:
-            listings = Listing.search([
-                ('product', '=', inbound_product.product.id),
-                ('channel', '=', channel.id)
-            ], limit=1)
-            if not listings:
-                self.raise_user_error(
-                    "Product %s is not listed on amazon" % (
-                        inbound_product.product.rec_name
-                    )
-                )
-            listing, = listings
+        # SKU sent to amazon => Product
+        products_by_sku = {}
+        for product, quantity in items:
+            listing = listings_by_product.get(product.id)
+            if listing is None:
+                cls.raise_user_error('product_not_listed', {
+                    'product': product.rec_name,
+                })
 
             fba_code = listing.fba_code
             if not listing.fba_code:
-                fba_code = inbound_product.product.code
+                fba_code = product.code
 
-            fba_products.append(
-                (fba_code, inbound_product.quantity)
-            )
-
-        request_items = dict(Member=[{
-            'SellerSKU': sku,
-            'Quantity': str(int(qty)),
-        } for sku, qty in fba_products])
+            fba_products.append((fba_code, quantity))
+            products_by_sku[fba_code] = product
 
-        # Create Inbound shipment plan, that would return info
-        # required to create inbound shipment
+        # Amazon is called from other threads, the connections and all the
+        # data they need are prepared here
+        pool = ThreadPool(cls._max_threads)
         try:
-            plan_response = mws_connection_api.create_inbound_shipment_plan(
-                ShipFromAddress=ship_from_address,
-                InboundShipmentPlanRequestItems=request_items
-            )
-        except Exception, e:  # XXX: Handle InvalidRequestException
-            self.raise_user_error(e.message)
-
-        shipment_values = []
-        for plan in plan_response.CreateInboundShipmentPlanResult.InboundShipmentPlans:  # noqa
-            shipment_header = {
-                'ShipmentName': plan.ShipmentId,
-                'ShipFromAddress': ship_from_address,
-                'DestinationFulfillmentCenterId':
-                    plan.DestinationFulfillmentCenterId,
-                'LabelPrepPreference': plan.LabelPrepType,
-                'ShipmentStatus': 'WORKING',
-            }
-            shipment_items = dict(Member=[{
-                'SellerSKU': item.SellerSKU,
-                'QuantityShipped': item.Quantity,
-            } for item in plan.Items])
-
-            # Create inbound shipment for each item
-            try:
-                mws_connection_api.create_inbound_shipment(
-                    ShipmentId=plan.ShipmentId,
-                    InboundShipmentHeader=shipment_header,
-                    InboundShipmentItems=shipment_items
+            # Create Inbound shipment plans, that would return info
+            # required to create inbound shipments
+            plans = sum(pool.map(_create_inbound_shipment_plan, [
+                (channel.get_mws_boto_connection_api(), ship_from_address,
+                    chunk)
+                for chunk in batch(fba_products, cls._plan_items_limit)
+            ]), [])
+
+            # Amazon could return SKUs other than the ones sent, find them
+            # all at once
+            unknown_skus = [
+                sku for plan in plans for sku, _ in plan['items']
+                if sku not in products_by_sku
+            ]
+            if unknown_skus:
+                products_by_sku.update(
+                    cls.find_products_using_skus(unknown_skus, channel)
                 )
-            except Exception, e:  # XXX: Handle InvalidRequestException
-                self.raise_user_error(e.message)
+            for plan in plans:
+                for sku, _ in plan['items']:
+                    if sku not in products_by_sku:
+                        cls.raise_user_error('sku_not_found', {'sku': sku})
+
+            # Create inbound shipment for each plan
+            pool.map(_create_inbound_shipment, [
+                (channel.get_mws_boto_connection_api(), ship_from_address,
+                    plan)
+                for plan in plans
+            ])
+        except AmazonInboundError, e:
+            cls.raise_user_error('amazon_error', {'error': e.message})
+        finally:
+            pool.close()
+            pool.join()
 
+        shipment_values = []
+        for plan in plans:
             moves = []
-            for item in plan.Items:
-
-                # Find product for sku returned from amazon
-                product = self.find_product_using_sku(item.SellerSKU, channel)
+            for sku, quantity in plan['items']:
+                product = products_by_sku[sku]
                 moves.append({
                     'from_location': from_location,
                     'to_location': to_location,
                     'product': product.id,
-                    'quantity': int(item.Quantity),
+                    'quantity': int(quantity),
                     'uom': product.default_uom.id,
+                    'amazon_sku': sku,
                 })
 
             shipment_values.append({
                 'from_location': from_location,
                 'to_location': to_location,
-                'mws_inbound_shipment_id': plan.ShipmentId,
+                'mws_inbound_shipment_id': plan['shipment_id'],
                 'moves': [('create', moves)],
             })
 
@@ -355,13 +687,153 @@ class InboundShipmentCreate(Wizard):
         Shipment.assign(shipments)
         return shipments
 
-    def do_create_(self, action):
 
-        shipments = self.create_inbound_shipment()
+class InboundShipmentRequestLine(ModelSQL, ModelView):
+    "Inbound Shipment Request Line"
+    __name__ = 'inbound_shipment.request.line'
+
+    request = fields.Many2One(
+        'inbound_shipment.request', 'Request', required=True, select=True,
+        ondelete='CASCADE'
+    )
+    product = fields.Many2One('product.product', 'Product', required=True)
+    quantity = fields.Integer('Quantity', required=True)
+
+
+class AmazonInboundError(Exception):
+    "Error of amazon while creating inbound shipments"
+
+
+def _create_inbound_shipment_plan(args):
+    """
+    Create the inbound shipment plans for a chunk of items on amazon
+
+    :param args: Tuple of (MWS connection, ship from address, list of
+                 (sku, quantity))
+    :returns: List of plans as dictionaries
+    """
+    mws_connection_api, ship_from_address, fba_products = args
+
+    request_items = dict(Member=[{
+        'SellerSKU': sku,
+        'Quantity': str(int(qty)),
+    } for sku, qty in fba_products])
+
+    try:
+        plan_response = mws_connection_api.create_inbound_shipment_plan(
+            ShipFromAddress=ship_from_address,
+            InboundShipmentPlanRequestItems=request_items
+        )
+    except Exception, e:  # XXX: Handle InvalidRequestException
+        raise AmazonInboundError(e.message)
+
+    return [{
+        'shipment_id': plan.ShipmentId,
+        'destination': plan.DestinationFulfillmentCenterId,
+        'label_prep': plan.LabelPrepType,
+        'items': [(item.SellerSKU, item.Quantity) for item in plan.Items],
+    } for plan in plan_response.CreateInboundShipmentPlanResult.InboundShipmentPlans]  # noqa
+
+
+def _create_inbound_shipment(args):
+    """
+    Create the inbound shipment of a plan on amazon
+
+    :param args: Tuple of (MWS connection, ship from address, plan)
+    """
+    mws_connection_api, ship_from_address, plan = args
+
+    shipment_header = {
+        'ShipmentName': plan['shipment_id'],
+        'ShipFromAddress': ship_from_address,
+        'DestinationFulfillmentCenterId': plan['destination'],
+        'LabelPrepPreference': plan['label_prep'],
+        'ShipmentStatus': 'WORKING',
+    }
+    shipment_items = dict(Member=[{
+        'SellerSKU': sku,
+        'QuantityShipped': quantity,
+    } for sku, quantity in plan['items']])
+
+    try:
+        mws_connection_api.create_inbound_shipment(
+            ShipmentId=plan['shipment_id'],
+            InboundShipmentHeader=shipment_header,
+            InboundShipmentItems=shipment_items
+        )
+    except Exception, e:  # XXX: Handle InvalidRequestException
+        raise AmazonInboundError(e.message)
+
+
+class InboundShipmentCreate(Wizard):
+    "Create Inbound Shipment"
+    __name__ = "inbound_shipment.create"
+
+    start = StateView(
+        'inbound_shipment.create.start',
+        'amazon_mws.inbound_shipment_create_start_form',
+        [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_', 'tryton-go-next', default=True),
+        ]
+    )
+    create_ = StateTransition()
+    open_shipments = StateAction('stock.act_shipment_internal_form')
+    open_request = StateAction('amazon_mws.act_inbound_shipment_request')
+
+    def get_channel(self):
+        """
+        Return the channel of the FBA warehouse of the destination
+        """
+        Request = Pool().get('inbound_shipment.request')
+
+        to_location = self.start.to_location
+        channel = to_location.fba_channel
+        if not channel:
+            Request.raise_user_error('warehouse_not_mapped', {
+                'warehouse': to_location.parent.rec_name,
+            })
+        return channel
+
+    def create_inbound_shipment(self):
+        Request = Pool().get('inbound_shipment.request')
+
+        return Request.create_inbound_shipments(
+            self.get_channel(), self.start.from_location,
+            self.start.to_location,
+            [(p.product, p.quantity) for p in self.start.products]
+        )
 
+    def transition_create_(self):
+        Request = Pool().get('inbound_shipment.request')
+
+        if len(self.start.products) <= Request._plan_items_limit:
+            self.shipments = self.create_inbound_shipment()
+            return 'open_shipments'
+
+        # Too large to wait for, the request is sent by a cron
+        self.request, = Request.create([{
+            'channel': self.get_channel().id,
+            'from_location': self.start.from_location.id,
+            'to_location': self.start.to_location.id,
+            'lines': [('create', [{
+                'product': p.product.id,
+                'quantity': p.quantity,
+            } for p in self.start.products])],
+        }])
+        return 'open_request'
+
+    def do_open_shipments(self, action):
         action['pyson_domain'] = PYSONEncoder().encode(
-            [('id', 'in', map(int, shipments))]
+            [('id', 'in', map(int, self.shipments))]
         )
         action['name'] = "Inbound Shipments"
 
         return action, {}
+
+    def do_open_request(self, action):
+        action['pyson_domain'] = PYSONEncoder().encode(
+            [('id', '=', self.request.id)]
+        )
+
+        return action, {}
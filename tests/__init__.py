@@ -11,6 +11,8 @@ import trytond.tests.test_tryton
 from tests.test_views import TestViewDepend
 from tests.test_product import TestProduct
 from tests.test_sale import TestSale
+from tests.test_feed import TestFeed, TestAmazonFeed
+from tests.test_shipment import TestShipment
 
 
 def suite():
@@ -22,6 +24,9 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestViewDepend),
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
+        unittest.TestLoader().loadTestsFromTestCase(TestFeed),
+        unittest.TestLoader().loadTestsFromTestCase(TestAmazonFeed),
+        unittest.TestLoader().loadTestsFromTestCase(TestShipment),
     ])
     return test_suite
 
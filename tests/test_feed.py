@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+"""
+    test_feed
+
+    Tests Feed
+
+"""
+import sys
+import os
+import hashlib
+from decimal import Decimal
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+
+import unittest
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from lxml import etree
+from lxml.builder import E
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from trytond.modules.amazon_mws.feed import FeedWriter, FlatFileWriter, \
+    parse_processing_report, parse_flat_file_processing_report
+from test_base import TestBase
+
+PROCESSING_REPORT = """<?xml version="1.0" encoding="UTF-8"?>
+<AmazonEnvelope xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xsi:noNamespaceSchemaLocation="amzn-envelope.xsd">
+  <Header>
+    <DocumentVersion>1.02</DocumentVersion>
+    <MerchantIdentifier>1234</MerchantIdentifier>
+  </Header>
+  <MessageType>ProcessingReport</MessageType>
+  <Message>
+    <MessageID>1</MessageID>
+    <ProcessingReport>
+      <DocumentTransactionID>4200000000</DocumentTransactionID>
+      <StatusCode>Complete</StatusCode>
+      <ProcessingSummary>
+        <MessagesProcessed>3</MessagesProcessed>
+        <MessagesSuccessful>1</MessagesSuccessful>
+        <MessagesWithError>1</MessagesWithError>
+        <MessagesWithWarning>1</MessagesWithWarning>
+      </ProcessingSummary>
+      <Result>
+        <MessageID>2</MessageID>
+        <ResultCode>Error</ResultCode>
+        <ResultMessageCode>8560</ResultMessageCode>
+        <ResultDescription>SKU SKU-2 is not listed</ResultDescription>
+      </Result>
+      <Result>
+        <MessageID>3</MessageID>
+        <ResultCode>Warning</ResultCode>
+        <ResultMessageCode>5000</ResultMessageCode>
+        <ResultDescription>Price is too high</ResultDescription>
+      </Result>
+    </ProcessingReport>
+  </Message>
+</AmazonEnvelope>
+"""
+
+FLAT_FILE_PROCESSING_REPORT = """Feed Processing Summary:
+\tNumber of records processed\t\t3
+\tNumber of records successful\t\t1
+
+original-record-number\tsku\terror-code\terror-type\terror-message
+2\tSKU-2\t8560\tError\tSKU SKU-2 is not listed
+3\tSKU-3\t5000\tWarning\tPrice is too high
+"""
+
+
+class TestFeed(unittest.TestCase):
+    '''
+    Tests Feed
+    '''
+
+    def get_message(self, message_id):
+        return E.Message(
+            E.MessageID(str(message_id)),
+            E.OperationType('Update'),
+            E.Inventory(
+                E.SKU('SKU-%s' % message_id),
+                E.Quantity('1'),
+            )
+        )
+
+    def test_0010_feed_writer(self):
+        """
+        Tests that messages are streamed into an amazon envelope
+        """
+        with FeedWriter('1234', 'Inventory') as writer:
+            for message_id in range(1, 4):
+                writer.write(self.get_message(message_id))
+
+        feed_file, = writer.feeds
+        content = feed_file.read()
+        envelope = etree.fromstring(content)
+
+        self.assertEqual(envelope.tag, 'AmazonEnvelope')
+        self.assertEqual(
+            envelope.findtext('Header/MerchantIdentifier'), '1234'
+        )
+        self.assertEqual(envelope.findtext('MessageType'), 'Inventory')
+        self.assertEqual(len(envelope.findall('Message')), 3)
+        self.assertEqual(feed_file.message_ids, ['1', '2', '3'])
+        self.assertEqual(feed_file.size, len(content))
+        self.assertEqual(feed_file.md5, hashlib.md5(content).hexdigest())
+
+    def test_0020_feed_writer_split(self):
+        """
+        Tests that feeds are split at the message and size limits
+        """
+        with FeedWriter('1234', 'Inventory', max_messages=2) as writer:
+            for message_id in range(1, 6):
+                writer.write(self.get_message(message_id))
+
+        self.assertEqual(
+            [feed_file.message_ids for feed_file in writer.feeds],
+            [['1', '2'], ['3', '4'], ['5']]
+        )
+        for feed_file in writer.feeds:
+            envelope = etree.fromstring(feed_file.read())
+            self.assertEqual(
+                len(envelope.findall('Message')), feed_file.message_count
+            )
+
+        message_size = len(etree.tostring(self.get_message(1)))
+        with FeedWriter(
+                '1234', 'Inventory', max_size=message_size * 3) as writer:
+            for message_id in range(1, 8):
+                writer.write(self.get_message(message_id))
+
+        self.assertEqual(
+            [feed_file.message_count for feed_file in writer.feeds],
+            [3, 3, 1]
+        )
+
+    def test_0025_feed_content_hash(self):
+        """
+        Tests that the content hash of feeds does not depend on the message
+        ids
+        """
+        with FeedWriter('1234', 'Inventory') as writer1:
+            writer1.write(self.get_message(1))
+        with FeedWriter('1234', 'Inventory') as writer2:
+            message = self.get_message(1)
+            message.find('MessageID').text = '42'
+            writer2.write(message)
+        with FeedWriter('1234', 'Inventory') as writer3:
+            writer3.write(self.get_message(2))
+
+        self.assertNotEqual(writer1.feeds[0].md5, writer2.feeds[0].md5)
+        self.assertEqual(
+            writer1.feeds[0].content_hash, writer2.feeds[0].content_hash
+        )
+        self.assertNotEqual(
+            writer1.feeds[0].content_hash, writer3.feeds[0].content_hash
+        )
+
+    def test_0030_parse_processing_report(self):
+        """
+        Tests parsing of the processing report of a feed
+        """
+        parsed = list(parse_processing_report(StringIO(PROCESSING_REPORT)))
+
+        self.assertEqual(parsed[0], ('summary', {
+            'processed': 3,
+            'successful': 1,
+            'with_error': 1,
+            'with_warning': 1,
+        }))
+        self.assertEqual(
+            [(values['message_id'], values['code'])
+                for kind, values in parsed[1:]],
+            [('2', 'Error'), ('3', 'Warning')]
+        )
+
+    def test_0040_flat_file_writer(self):
+        """
+        Tests that rows are streamed into tab delimited feeds
+        """
+        header = ['sku', 'price', 'quantity']
+        with FlatFileWriter(header, max_messages=2) as writer:
+            for index in range(1, 4):
+                writer.write(['SKU-%s' % index, '10.00', str(index)])
+
+        self.assertEqual(
+            [feed_file.message_ids for feed_file in writer.feeds],
+            [['1', '2'], ['1']]
+        )
+        content = writer.feeds[0].read()
+        self.assertEqual(
+            content,
+            'sku\tprice\tquantity\nSKU-1\t10.00\t1\nSKU-2\t10.00\t2\n'
+        )
+        self.assertEqual(writer.feeds[0].size, len(content))
+        self.assertEqual(
+            writer.feeds[0].md5, hashlib.md5(content).hexdigest()
+        )
+
+    def test_0050_parse_flat_file_processing_report(self):
+        """
+        Tests parsing of the processing report of a flat file feed
+        """
+        parsed = list(parse_flat_file_processing_report(
+            StringIO(FLAT_FILE_PROCESSING_REPORT)
+        ))
+
+        self.assertEqual(parsed[0], ('summary', {
+            'processed': 3,
+            'successful': 1,
+            'with_error': 1,
+            'with_warning': 1,
+        }))
+        self.assertEqual(
+            [(values['message_id'], values['code'], values['description'])
+                for kind, values in parsed[1:]],
+            [
+                ('2', 'Error', 'SKU SKU-2 is not listed'),
+                ('3', 'Warning', 'Price is too high'),
+            ]
+        )
+
+
+class TestAmazonFeed(TestBase):
+    """
+    Tests Amazon Feed records
+    """
+
+    def create_feed(self, content_hash, minutes_ago, **values):
+        """
+        Create a feed of price updates of two messages
+        """
+        Feed = POOL.get('amazon.mws.feed')
+
+        feed_values = {
+            'channel': self.sale_channel.id,
+            'feed_type': '_POST_PRODUCT_PRICING_DATA_',
+            'content_hash': content_hash,
+            'submitted_at': datetime.utcnow() - timedelta(
+                minutes=minutes_ago
+            ),
+            'messages': [('create', [
+                {'message_id': '1'}, {'message_id': '2'},
+            ])],
+        }
+        feed_values.update(values)
+        feed, = Feed.create([feed_values])
+        return feed
+
+    def test_0010_find_duplicate(self):
+        """
+        Tests that only the last feed of the type is a duplicate of a feed
+        with the same messages
+        """
+        Feed = POOL.get('amazon.mws.feed')
+        feed_type = '_POST_PRODUCT_PRICING_DATA_'
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'A')
+            )
+
+            feed_a = self.create_feed(
+                'A', 20, submission_id='1', state='done',
+                messages_with_error=0
+            )
+            self.assertEqual(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'A'),
+                feed_a
+            )
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'B')
+            )
+
+            # Price changed to B and back to A, A must be sent again
+            feed_b = self.create_feed(
+                'B', 10, submission_id='2', state='in_progress'
+            )
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'A')
+            )
+            self.assertEqual(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'B'),
+                feed_b
+            )
+
+            # Skipped feeds are not the last feed sent
+            self.create_feed(
+                'A', 5, state='skipped', duplicate_of=feed_a.id
+            )
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'A')
+            )
+            self.assertEqual(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'B'),
+                feed_b
+            )
+
+            # Feeds of other types are not compared
+            self.assertIsNone(Feed.find_duplicate(
+                self.sale_channel, '_POST_INVENTORY_AVAILABILITY_DATA_', 'B'
+            ))
+
+            # Feeds with errors or accepted long ago are sent again
+            Feed.write([feed_b], {
+                'state': 'done',
+                'messages_with_error': 1,
+            })
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'B')
+            )
+            Feed.write([feed_b], {
+                'messages_with_error': 0,
+                'submitted_at': datetime.utcnow() - timedelta(days=1),
+            })
+            self.assertIsNone(
+                Feed.find_duplicate(self.sale_channel, feed_type, 'B')
+            )
+
+    def test_0020_process_duplicate(self):
+        """
+        Tests that a skipped feed gets the results of the feed it is a
+        duplicate of
+        """
+        Feed = POOL.get('amazon.mws.feed')
+        Message = POOL.get('amazon.mws.feed.message')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            original = self.create_feed(
+                'A', 10, submission_id='1', state='in_progress'
+            )
+            duplicate = self.create_feed(
+                'A', 5, state='skipped', duplicate_of=original.id
+            )
+
+            # Nothing to copy until the original is processed
+            duplicate.process_duplicate()
+            self.assertEqual(
+                [m.state for m in Feed(duplicate.id).messages],
+                ['pending', 'pending']
+            )
+
+            message1, message2 = sorted(original.messages, key=lambda m: m.id)
+            original.set_message_results([
+                (message1, 'success', None),
+                (message2, 'warning', 'Price is too high'),
+            ], {
+                'messages_processed': 2,
+                'messages_successful': 1,
+                'messages_with_error': 0,
+                'messages_with_warning': 1,
+            })
+
+            Feed(duplicate.id).process_duplicate()
+            duplicate = Feed(duplicate.id)
+            self.assertEqual(duplicate.state, 'skipped')
+            self.assertEqual(duplicate.messages_with_warning, 1)
+            self.assertEqual(
+                [(m.message_id, m.state, m.result) for m in sorted(
+                    duplicate.messages, key=lambda m: m.id
+                )],
+                [('1', 'success', None), ('2', 'warning', 'Price is too high')]
+            )
+            self.assertEqual(Message.search([
+                ('feed', '=', duplicate.id),
+                ('state', '=', 'pending'),
+            ], count=True), 0)
+
+    def test_0030_process_cancellation(self):
+        """
+        Tests that the messages of a cancelled feed and of its duplicates
+        fail and their listings are sent again
+        """
+        Feed = POOL.get('amazon.mws.feed')
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'code1',
+                'asin': 'B00F5O69LA',
+                'amazon_price_fingerprint': '11.00 USD',
+            }])
+
+            feed = self.create_feed(
+                'A', 10, submission_id='1', state='in_progress',
+                messages=[('create', [{
+                    'message_id': '1',
+                    'origin': '%s,%s' % (listing.__name__, listing.id),
+                }])]
+            )
+            duplicate = self.create_feed(
+                'A', 5, state='skipped', duplicate_of=feed.id,
+                messages=[('create', [{'message_id': '1'}])]
+            )
+
+            feed.process_cancellation()
+
+            feed = Feed(feed.id)
+            self.assertEqual(feed.state, 'cancelled')
+            self.assertEqual([m.state for m in feed.messages], ['error'])
+            self.assertIsNone(Listing(listing.id).amazon_price_fingerprint)
+
+            duplicate = Feed(duplicate.id)
+            self.assertEqual(duplicate.state, 'skipped')
+            self.assertEqual(
+                [m.state for m in duplicate.messages], ['error']
+            )
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestFeed)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestAmazonFeed)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
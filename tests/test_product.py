@@ -67,6 +67,56 @@ class TestProduct(TestBase):
             self.assertEqual(product.upc.code, '123456789012')
             self.assertEqual(product.asin.code, 'BUYGBS6866')
 
+    def test_0015_code_fields_for_many_products(self):
+        """Tests the function fields for codes read on multiple products
+        """
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                    'codes': [('create', [{
+                        'code': 'BUYGBS6866',
+                        'code_type': 'asin',
+                    }, {
+                        'code': '123456789012',
+                        'code_type': 'upc',
+                    }])]
+                }, {
+                    'code': 'code2',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                    'codes': [('create', [{
+                        'code': 'BUYGBS6867',
+                        'code_type': 'asin',
+                    }])]
+                }])]
+            }])
+
+            product1, product2 = Product.search(
+                [('template', '=', template.id)], order=[('code', 'ASC')]
+            )
+            values = Product.get_codes(
+                [product1, product2], ['asin', 'upc', 'gtin']
+            )
+
+            self.assertEqual(product1.asin.code, 'BUYGBS6866')
+            self.assertEqual(product2.asin.code, 'BUYGBS6867')
+            self.assertEqual(product1.upc.code, '123456789012')
+            self.assertIsNone(values['upc'][product2.id])
+            self.assertIsNone(values['gtin'][product1.id])
+            self.assertIsNone(values['gtin'][product2.id])
+
     def test_0020_create_product_using_amazon_data(self):
         """
         Tests if product is created using amazon data
@@ -86,6 +136,477 @@ class TestProduct(TestBase):
 
                 self.assertEqual(Product.search([], count=True), 1)
 
+    def test_0030_create_many_products_using_amazon_data(self):
+        """
+        Tests if products are created in bulk using amazon data
+        """
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                {'current_channel': self.sale_channel.id}
+            ):
+                self.assertEqual(Product.search([], count=True), 0)
+
+                product_data1 = load_json('products', 'product-1')
+                product_data1['Id']['value'] = 'SKU-1'
+                product_data2 = load_json('products', 'product-2')
+                product_data2['Id']['value'] = 'SKU-2'
+
+                product1, product2 = Product.create_many_using_amazon_data(
+                    [product_data1, product_data2]
+                )
+
+                self.assertEqual(Product.search([], count=True), 2)
+                self.assertEqual(product1.code, 'SKU-1')
+                self.assertEqual(product2.code, 'SKU-2')
+
+                # Product without a list price on amazon
+                self.assertEqual(product1.list_price, Decimal('0.01'))
+                self.assertEqual(product2.list_price, Decimal('1.00'))
+
+    def test_0040_import_listings_from_report(self):
+        """
+        Tests import of listings from the merchant listings report
+        """
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                {'current_channel': self.sale_channel.id}
+            ):
+                product_data = load_json('products', 'product-2')
+                product_data['Id']['value'] = 'SKU-MFN'
+                product = Product.create_using_amazon_data(product_data)
+
+                report = '\n'.join([
+                    '\t'.join([
+                        'item-name', 'seller-sku', 'asin1',
+                        'fulfillment-channel'
+                    ]),
+                    '\t'.join([
+                        'A red coffee mug', 'SKU-MFN', 'B00F5O69LA',
+                        'DEFAULT'
+                    ]),
+                    '\t'.join([
+                        'A red coffee mug', 'SKU-AFN', 'B00F5O69LA',
+                        'AMAZON_NA'
+                    ]),
+                ])
+
+                listings = self.sale_channel.import_amazon_listings_from_report(  # noqa
+                    report
+                )
+                self.assertEqual(len(listings), 1)
+
+                listing, = Listing.search([])
+                self.assertEqual(listing.product, product)
+                self.assertEqual(listing.asin, 'B00F5O69LA')
+                self.assertEqual(listing.product_identifier, 'SKU-MFN')
+                self.assertEqual(listing.fba_code, 'SKU-AFN')
+
+                # Importing same report again does not change anything
+                self.assertEqual(
+                    self.sale_channel.import_amazon_listings_from_report(
+                        report
+                    ), []
+                )
+                self.assertEqual(Listing.search([], count=True), 1)
+
+    def test_0050_amazon_prices_using_price_list(self):
+        """
+        Tests that prices exported to amazon are computed with the price
+        list of the channel
+        """
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }, {
+                    'code': 'code2',
+                    'list_price': Decimal('20.0'),
+                    'cost_price': Decimal('8.0'),
+                }, {
+                    'code': 'code3',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('5.0'),
+                }])]
+            }])
+            products = Product.search(
+                [('template', '=', template.id)], order=[('code', 'ASC')]
+            )
+
+            # Price list of the channel adds a margin of 10%
+            self.assertEqual(self.party_pl_margin, Decimal('1.10'))
+            prices = self.sale_channel.get_amazon_prices(products)
+
+            self.assertEqual(
+                [prices[product.id] for product in products],
+                [Decimal('11.00'), Decimal('22.00'), Decimal('11.00')]
+            )
+
+    def test_0060_sync_fba_inventory_from_report(self):
+        """
+        Tests that stock of the FBA warehouse is adjusted to the sellable
+        quantity in the AFN inventory report
+        """
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(
+                {'current_channel': self.sale_channel.id}
+            ):
+                product_data = load_json('products', 'product-2')
+                product_data['Id']['value'] = 'SKU-MFN'
+                product = Product.create_using_amazon_data(product_data)
+                Listing.create([{
+                    'channel': self.sale_channel.id,
+                    'product': product.id,
+                    'product_identifier': 'SKU-MFN',
+                    'fba_code': 'SKU-AFN',
+                    'asin': 'B00F5O69LA',
+                }])
+
+                report = '\n'.join([
+                    '\t'.join([
+                        'seller-sku', 'fulfillment-channel-sku', 'asin',
+                        'condition-type', 'Warehouse-Condition-code',
+                        'Quantity Available'
+                    ]),
+                    '\t'.join([
+                        'SKU-AFN', 'X0001', 'B00F5O69LA', 'NewItem',
+                        'SELLABLE', '5'
+                    ]),
+                    '\t'.join([
+                        'SKU-AFN', 'X0001', 'B00F5O69LA', 'NewItem',
+                        'UNSELLABLE', '2'
+                    ]),
+                ])
+
+                inventory = \
+                    self.sale_channel.sync_amazon_fba_inventory_from_report(
+                        report
+                    )
+                self.assertEqual(inventory.state, 'done')
+
+                location = self.sale_channel.fba_warehouse.storage_location
+                with Transaction().set_context(locations=[location.id]):
+                    self.assertEqual(Product(product.id).quantity, 5)
+
+                # Nothing to adjust when stock is same as on amazon
+                self.assertIsNone(
+                    self.sale_channel.sync_amazon_fba_inventory_from_report(
+                        report
+                    )
+                )
+
+    def test_0070_export_inventory_of_dirty_listings(self):
+        """
+        Tests that stock moves mark the listings of the product dirty and
+        only dirty listings are exported to amazon
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+        SaleChannel = POOL.get('sale.channel')
+        Feed = POOL.get('amazon.mws.feed')
+
+        def upload_amazon_feeds(
+                feeds_api, marketplace_id, submissions, feed_type):
+            # Record the feeds as if they were sent to amazon
+            for index, (_, values) in enumerate(submissions):
+                values.update({
+                    'submission_id': str(index + 1),
+                    'state': 'submitted',
+                })
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'code1',
+                'asin': 'B00F5O69LA',
+                'amazon_inventory_dirty': False,
+            }])
+
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+            with Transaction().set_context(company=self.company.id):
+                move, = Move.create([{
+                    'product': product.id,
+                    'uom': self.uom.id,
+                    'quantity': 5,
+                    'from_location': lost_found.id,
+                    'to_location':
+                        self.sale_channel.warehouse.storage_location.id,
+                    'company': self.company.id,
+                }])
+                Move.do([move])
+
+            self.assertTrue(Listing(listing.id).amazon_inventory_dirty)
+
+            original_upload = SaleChannel.upload_amazon_feeds
+            SaleChannel.upload_amazon_feeds = staticmethod(
+                upload_amazon_feeds
+            )
+            try:
+                Listing.export_bulk_inventory([Listing(listing.id)])
+                self.assertFalse(Listing(listing.id).amazon_inventory_dirty)
+                self.assertEqual(Feed.search([
+                    ('feed_type', '=', '_POST_INVENTORY_AVAILABILITY_DATA_'),
+                ], count=True), 1)
+
+                # Listing did not change since the last export
+                Listing.export_bulk_inventory([Listing(listing.id)])
+                self.assertEqual(Feed.search([
+                    ('feed_type', '=', '_POST_INVENTORY_AVAILABILITY_DATA_'),
+                ], count=True), 1)
+            finally:
+                SaleChannel.upload_amazon_feeds = staticmethod(original_upload)
+
+    def test_0080_get_amazon_listing_rows(self):
+        """
+        Tests that the active listings of the channel are read a page at a
+        time
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': code,
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                } for code in ('code1', 'code2', 'code3')])]
+            }])
+            products = dict(
+                (product.code, product) for product in template.products
+            )
+            listing1, listing2, listing3 = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': products[code].id,
+                'product_identifier': code,
+                'asin': 'ASIN-%s' % code,
+                'state': state,
+            } for code, state in [
+                ('code1', 'active'), ('code2', 'active'),
+                ('code3', 'disabled'),
+            ]])
+
+            # Disabled listings are not read
+            self.assertEqual(
+                list(self.sale_channel.get_amazon_listing_rows(page_size=1)),
+                [
+                    [(listing1.id, products['code1'].id, 'code1', None,
+                        True)],
+                    [(listing2.id, products['code2'].id, 'code2', None,
+                        True)],
+                ]
+            )
+            self.assertEqual(
+                list(self.sale_channel.get_amazon_listing_rows([
+                    listing2.id, listing3.id
+                ])),
+                [[(listing2.id, products['code2'].id, 'code2', None, True)]]
+            )
+            self.assertEqual(
+                list(self.sale_channel.get_amazon_listing_rows([])), []
+            )
+
+    def test_0090_export_changed_prices(self):
+        """
+        Tests that only the prices which changed since the last export are
+        sent to amazon
+        """
+        Template = POOL.get('product.template')
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        SaleChannel = POOL.get('sale.channel')
+        Feed = POOL.get('amazon.mws.feed')
+
+        submission_ids = []
+
+        def upload_amazon_feeds(
+                feeds_api, marketplace_id, submissions, feed_type):
+            # Record the feeds as if they were sent to amazon
+            for _, values in submissions:
+                if values.get('state') == 'skipped':
+                    continue
+                submission_ids.append(str(len(submission_ids) + 1))
+                values.update({
+                    'submission_id': submission_ids[-1],
+                    'state': 'submitted',
+                })
+
+        def exported_listings():
+            feed, = Feed.search([
+                ('submission_id', '=', submission_ids[-1]),
+            ])
+            return sorted(message.origin.id for message in feed.messages)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }, {
+                    'code': 'code2',
+                    'list_price': Decimal('20.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product1, product2 = Product.search(
+                [('template', '=', template.id)], order=[('code', 'ASC')]
+            )
+            listing1, listing2 = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': product.code,
+                'asin': 'ASIN-%s' % product.code,
+            } for product in (product1, product2)])
+
+            original_upload = SaleChannel.upload_amazon_feeds
+            SaleChannel.upload_amazon_feeds = staticmethod(
+                upload_amazon_feeds
+            )
+            try:
+                self.assertEqual(self.sale_channel.export_product_prices(), 2)
+                self.assertEqual(
+                    exported_listings(), sorted([listing1.id, listing2.id])
+                )
+                self.assertEqual([
+                    listing.amazon_price_fingerprint
+                    for listing in Listing.browse([listing1, listing2])
+                ], ['11.00 USD', '22.00 USD'])
+
+                # Prices did not change since the last export
+                self.assertEqual(self.sale_channel.export_product_prices(), 0)
+                self.assertEqual(len(submission_ids), 1)
+
+                # Only the changed price is sent again
+                Product.write([product2], {'list_price': Decimal('30.0')})
+                self.assertEqual(self.sale_channel.export_product_prices(), 1)
+                self.assertEqual(exported_listings(), [listing2.id])
+                self.assertEqual(
+                    Listing(listing2.id).amazon_price_fingerprint,
+                    '33.00 USD'
+                )
+
+                # All the prices are sent when forced
+                self.assertEqual(
+                    self.sale_channel.export_product_prices(force=True), 2
+                )
+                self.assertEqual(len(submission_ids), 3)
+            finally:
+                SaleChannel.upload_amazon_feeds = staticmethod(original_upload)
+
+    def test_0100_find_using_amazon_sku_cache(self):
+        """
+        Tests that the listings found by SKU are not served from the cache
+        once the listings change
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            template, = Template.create([{
+                'name': 'Test Product',
+                'default_uom': self.uom.id,
+                'account_expense': self.get_account_by_kind('expense'),
+                'account_revenue': self.get_account_by_kind('revenue'),
+                'products': [('create', [{
+                    'code': 'code1',
+                    'list_price': Decimal('10.0'),
+                    'cost_price': Decimal('8.0'),
+                }])]
+            }])
+            product, = template.products
+            listing, = Listing.create([{
+                'channel': self.sale_channel.id,
+                'product': product.id,
+                'product_identifier': 'code1',
+                'fba_code': 'FBA1',
+                'asin': 'B00F5O69LA',
+            }])
+
+            self.assertEqual(
+                Listing.find_using_amazon_sku(self.sale_channel, 'code1'),
+                (listing.id, product.id)
+            )
+            self.assertEqual(
+                Listing.find_using_amazon_sku(self.sale_channel, 'FBA1'),
+                (listing.id, product.id)
+            )
+
+            Listing.write([listing], {
+                'product_identifier': 'code1-new',
+                'fba_code': None,
+            })
+            self.assertIsNone(
+                Listing.find_using_amazon_sku(self.sale_channel, 'code1')
+            )
+            self.assertIsNone(
+                Listing.find_using_amazon_sku(self.sale_channel, 'FBA1')
+            )
+            self.assertEqual(
+                Listing.find_using_amazon_sku(self.sale_channel, 'code1-new'),
+                (listing.id, product.id)
+            )
+
+            Listing.delete([listing])
+            self.assertIsNone(
+                Listing.find_using_amazon_sku(self.sale_channel, 'code1-new')
+            )
+
 
 def suite():
     """
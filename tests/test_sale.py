@@ -7,6 +7,7 @@
 """
 import os
 import sys
+import copy
 import unittest
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -466,6 +467,370 @@ class TestSale(TestBase):
                     self.assertEqual(shipping_address.country, None)
                     self.assertEqual(shipping_address.subdivision, None)
 
+    def test_0060_process_queued_sale(self):
+        """
+        Tests that sales created for the order queue are processed by the
+        queue
+        """
+        Sale = POOL.get('sale.sale')
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        ChannelState = POOL.get('sale.channel.order_state')
+        OrderQueue = POOL.get('amazon.mws.order_queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.sale_channel.id,
+                'company': self.company.id,
+            }):
+                order_data = load_json(
+                    'orders', 'order_list'
+                )['Orders']['Order']
+                line_data = load_json(
+                    'orders', 'order_items'
+                )['OrderItems']['OrderItem']
+
+                ChannelState.create([{
+                    'name': 'Shipped',
+                    'code': 'Shipped',
+                    'action': 'import_as_past',
+                    'invoice_method': 'order',
+                    'shipment_method': 'order',
+                    'channel': self.sale_channel,
+                }])
+
+                product_data = load_json('products', 'product-2')
+                product_data.update({
+                    'Id': {
+                        'value': line_data['SellerSKU']['value']
+                    }
+                })
+                product = Product.create_from(self.sale_channel, product_data)
+
+                Listing(
+                    product=product,
+                    channel=self.sale_channel,
+                    product_identifier=line_data['SellerSKU']['value'],
+                    asin=product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+                ).save()
+
+                sale, = Sale.create_many_using_amazon_data(
+                    [(order_data, line_data)], enqueue=True
+                )
+
+                # Sale is only created, the queue processes it
+                self.assertEqual(sale.state, 'draft')
+                entry, = OrderQueue.search([])
+                self.assertEqual(entry.sale, sale)
+                self.assertEqual(entry.state, 'pending')
+                self.assertEqual(entry.order_status, 'Shipped')
+
+                OrderQueue.process(OrderQueue.lock_pending([entry.id]))
+
+                self.assertEqual(Sale(sale.id).state, 'done')
+                self.assertEqual(OrderQueue(entry.id).state, 'done')
+
+                # Entries which are done are not locked again
+                self.assertEqual(OrderQueue.lock_pending([entry.id]), [])
+
+    def test_0070_fulfillment_outbox(self):
+        """
+        Tests that queued fulfillments are sent when the batch is full and
+        queued again when their feed is cancelled
+        """
+        Sale = POOL.get('sale.sale')
+        Address = POOL.get('party.address')
+        SaleChannel = POOL.get('sale.channel')
+        Fulfillment = POOL.get('amazon.mws.fulfillment')
+        Feed = POOL.get('amazon.mws.feed')
+
+        submission_ids = []
+
+        def upload_amazon_feeds(
+                feeds_api, marketplace_id, submissions, feed_type):
+            # Feeds are accepted as if they were sent to amazon
+            for _, values in submissions:
+                if values.get('state') == 'skipped':
+                    continue
+                submission_ids.append(str(len(submission_ids) + 1))
+                values.update({
+                    'submission_id': submission_ids[-1],
+                    'state': 'submitted',
+                })
+
+        message = '<OrderFulfillment><AmazonOrderID>%s</AmazonOrderID>' \
+            '</OrderFulfillment>'
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            SaleChannel.write([self.sale_channel], {
+                'amazon_fulfillment_batch_size': 2,
+            })
+            address, = Address.create([{
+                'party': self.party.id,
+                'name': 'ABC',
+            }])
+
+            with Transaction().set_context(company=self.company.id):
+                sale1, sale2 = Sale.create([{
+                    'reference': reference,
+                    'channel_identifier': reference,
+                    'party': self.party.id,
+                    'invoice_address': address.id,
+                    'shipment_address': address.id,
+                    'channel': self.sale_channel.id,
+                    'currency': self.usd.id,
+                } for reference in ('ORDER-1', 'ORDER-2')])
+
+            def queue_fulfillments(sales):
+                return Fulfillment.create([{
+                    'channel': self.sale_channel.id,
+                    'sale': sale.id,
+                    'message': message % sale.reference,
+                } for sale in sales])
+
+            original_upload = SaleChannel.upload_amazon_feeds
+            SaleChannel.upload_amazon_feeds = staticmethod(
+                upload_amazon_feeds
+            )
+            try:
+                fulfillment1, = queue_fulfillments([sale1])
+
+                # Batch is not full yet
+                Fulfillment.submit_if_batch_full([self.sale_channel])
+                self.assertEqual(
+                    Fulfillment(fulfillment1.id).state, 'pending'
+                )
+
+                fulfillment2, = queue_fulfillments([sale2])
+                Fulfillment.submit_if_batch_full([self.sale_channel])
+
+                fulfillments = Fulfillment.browse(
+                    [fulfillment1, fulfillment2]
+                )
+                self.assertEqual(
+                    [(f.state, f.attempts) for f in fulfillments],
+                    [('submitted', 1), ('submitted', 1)]
+                )
+
+                # Both are sent in one feed, which amazon cancels
+                feed, = Feed.search([('submission_id', '=', '1')])
+                self.assertEqual(
+                    feed.feed_type, '_POST_ORDER_FULFILLMENT_DATA_'
+                )
+                feed.process_cancellation()
+
+                fulfillments = Fulfillment.browse(
+                    [fulfillment1, fulfillment2]
+                )
+                self.assertEqual(
+                    [f.state for f in fulfillments], ['pending', 'pending']
+                )
+
+                # Sent again and accepted by amazon
+                Fulfillment.submit_using_cron()
+                feed, = Feed.search([('submission_id', '=', '2')])
+                feed.set_message_results([
+                    (feed_message, 'success', None)
+                    for feed_message in feed.messages
+                ], {'messages_processed': 2, 'messages_with_error': 0})
+
+                fulfillments = Fulfillment.browse(
+                    [fulfillment1, fulfillment2]
+                )
+                self.assertEqual(
+                    [(f.state, f.attempts) for f in fulfillments],
+                    [('done', 2), ('done', 2)]
+                )
+
+                # Same fulfillments again are not sent, they are done with
+                # the results of the feed accepted by amazon
+                fulfillment3, fulfillment4 = queue_fulfillments(
+                    [sale1, sale2]
+                )
+                Fulfillment.submit_using_cron()
+                self.assertEqual(len(submission_ids), 2)
+
+                fulfillments = Fulfillment.browse(
+                    [fulfillment3, fulfillment4]
+                )
+                self.assertEqual(
+                    [f.state for f in fulfillments], ['done', 'done']
+                )
+            finally:
+                SaleChannel.upload_amazon_feeds = staticmethod(
+                    original_upload
+                )
+
+    def setup_amazon_order(self):
+        """
+        Create the product, listing and order state needed to import the
+        orders of the json files and return (order data, line data)
+        """
+        Product = POOL.get('product.product')
+        Listing = POOL.get('product.product.channel_listing')
+        ChannelState = POOL.get('sale.channel.order_state')
+
+        order_data = load_json('orders', 'order_list')['Orders']['Order']
+        line_data = load_json(
+            'orders', 'order_items'
+        )['OrderItems']['OrderItem']
+
+        ChannelState.create([{
+            'name': 'Shipped',
+            'code': 'Shipped',
+            'action': 'import_as_past',
+            'invoice_method': 'order',
+            'shipment_method': 'order',
+            'channel': self.sale_channel,
+        }])
+
+        product_data = load_json('products', 'product-2')
+        product_data.update({
+            'Id': {
+                'value': line_data['SellerSKU']['value']
+            }
+        })
+        product = Product.create_from(self.sale_channel, product_data)
+
+        Listing(
+            product=product,
+            channel=self.sale_channel,
+            product_identifier=line_data['SellerSKU']['value'],
+            asin=product_data['Products']['Product']['Identifiers']["MarketplaceASIN"]["ASIN"]["value"],  # noqa
+        ).save()
+
+        return order_data, line_data
+
+    def test_0080_import_orders_enqueue(self):
+        """
+        Tests that orders imported in bulk are put in the order queue and an
+        order imported on its own is processed right away
+        """
+        Sale = POOL.get('sale.sale')
+        SaleChannel = POOL.get('sale.channel')
+        OrderQueue = POOL.get('amazon.mws.order_queue')
+
+        class Response(object):
+            def __init__(self, parsed):
+                self.parsed = parsed
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                order_data, line_data = self.setup_amazon_order()
+
+                other_order_data = copy.deepcopy(order_data)
+                other_order_data['AmazonOrderId']['value'] = 'ORDER-2'
+
+                class OrderAPI(object):
+                    def list_order_items(self, order_id):
+                        return Response({
+                            'OrderItems': {'OrderItem': line_data},
+                        })
+
+                    def get_order(self, order_ids):
+                        return Response({
+                            'Orders': {'Order': other_order_data},
+                        })
+
+                original_order_api = SaleChannel.get_amazon_order_api.im_func
+                SaleChannel.get_amazon_order_api = lambda self: OrderAPI()
+                try:
+                    # Same order twice on a page is created once
+                    sale1, sale2 = self.sale_channel.import_mws_order_bulk(
+                        [order_data, order_data]
+                    )
+                    self.assertEqual(sale1, sale2)
+                    self.assertEqual(sale1.state, 'draft')
+                    entry, = OrderQueue.search([])
+                    self.assertEqual(entry.sale, sale1)
+                    self.assertEqual(entry.state, 'pending')
+
+                    sale = self.sale_channel.import_order('ORDER-2')
+                    self.assertEqual(sale.channel_identifier, 'ORDER-2')
+                    self.assertEqual(sale.state, 'done')
+                    self.assertEqual(OrderQueue.search([], count=True), 1)
+
+                    # Orders already imported are not created again
+                    self.assertEqual(
+                        self.sale_channel.import_order('ORDER-2'), sale
+                    )
+                    self.assertEqual(
+                        Sale.search([], count=True), 2
+                    )
+                finally:
+                    SaleChannel.get_amazon_order_api = original_order_api
+
+    def test_0090_process_queue_batch(self):
+        """
+        Tests that the entries of a batch are processed together and one at
+        a time when the batch fails
+        """
+        Sale = POOL.get('sale.sale')
+        OrderQueue = POOL.get('amazon.mws.order_queue')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.sale_channel.id,
+                'company': self.company.id,
+            }):
+                order_data, line_data = self.setup_amazon_order()
+
+                orders = []
+                for order_id in ('ORDER-1', 'ORDER-2', 'ORDER-3'):
+                    order = copy.deepcopy(order_data)
+                    order['AmazonOrderId']['value'] = order_id
+                    orders.append((order, line_data))
+                sale1, sale2, sale3 = Sale.create_many_using_amazon_data(
+                    orders, enqueue=True
+                )
+                entry1, entry2, entry3 = OrderQueue.search(
+                    [], order=[('id', 'ASC')]
+                )
+
+                calls = []
+                original_process = Sale.process_amazon_orders.im_func
+
+                def process_amazon_orders(cls, orders):
+                    calls.append([sale for sale, _, _ in orders])
+                    if sale2 in calls[-1]:
+                        cls.raise_user_error('Failed to process ORDER-2')
+                    return original_process(cls, orders)
+
+                # The transaction of the test is kept, the worker commits
+                # and rolls back its own transaction
+                cursor = Transaction().cursor
+                cursor.commit = cursor.rollback = lambda: None
+                Sale.process_amazon_orders = classmethod(
+                    process_amazon_orders
+                )
+                try:
+                    OrderQueue.process_batch([entry1.id, entry3.id])
+                    self.assertEqual(calls, [[sale1, sale3]])
+                    self.assertEqual(
+                        [e.state for e in OrderQueue.browse([entry1, entry3])],
+                        ['done', 'done']
+                    )
+
+                    # Entries which are done are skipped
+                    calls[:] = []
+                    OrderQueue.process_batch([entry1.id, entry2.id])
+                    self.assertEqual(calls, [[sale2], [sale2]])
+                    entry2 = OrderQueue(entry2.id)
+                    self.assertEqual(entry2.state, 'failed')
+                    self.assertIn('Failed to process ORDER-2', entry2.error)
+                    self.assertEqual(Sale(sale2.id).state, 'draft')
+                finally:
+                    Sale.process_amazon_orders = classmethod(original_process)
+                    del cursor.commit, cursor.rollback
+
 
 def suite():
     """
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+"""
+    test_shipment
+
+    Tests Inbound Shipments
+
+"""
+import os
+import sys
+import unittest
+DIR = os.path.abspath(os.path.normpath(
+    os.path.join(
+        __file__,
+        '..', '..', '..', '..', '..', 'trytond'
+    )
+))
+if os.path.isdir(DIR):
+    sys.path.insert(0, os.path.dirname(DIR))
+from decimal import Decimal
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from test_base import TestBase
+from trytond.transaction import Transaction
+from trytond.exceptions import UserError
+
+
+class Data(object):
+    """
+    Data of a response of amazon, the fields are attributes as in the
+    responses of boto
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class MWSConnection(object):
+    """
+    Connection to amazon which plans a shipment for every item sent
+    """
+
+    def __init__(self, error=None):
+        self.error = error
+        self.plan_requests = []
+        self.shipment_ids = []
+
+    def create_inbound_shipment_plan(
+            self, ShipFromAddress, InboundShipmentPlanRequestItems):
+        items = InboundShipmentPlanRequestItems['Member']
+        self.plan_requests.append([item['SellerSKU'] for item in items])
+        return Data(CreateInboundShipmentPlanResult=Data(
+            InboundShipmentPlans=[Data(
+                ShipmentId='SHIP-%s' % item['SellerSKU'],
+                DestinationFulfillmentCenterId='FC1',
+                LabelPrepType='SELLER_LABEL',
+                Items=[Data(
+                    SellerSKU=item['SellerSKU'], Quantity=item['Quantity']
+                )],
+            ) for item in items]
+        ))
+
+    def create_inbound_shipment(
+            self, ShipmentId, InboundShipmentHeader, InboundShipmentItems):
+        if self.error:
+            raise Exception(self.error)
+        self.shipment_ids.append(ShipmentId)
+
+
+class TestShipment(TestBase):
+    """
+    Tests inbound shipments to amazon fulfillment centers
+    """
+
+    def setup_inbound_defaults(self):
+        """
+        Setup two listed products in stock and a location of the FBA
+        warehouse, after the defaults are setup
+        """
+        Template = POOL.get('product.template')
+        Listing = POOL.get('product.product.channel_listing')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+        Address = POOL.get('party.address')
+
+        warehouse = self.sale_channel.fba_warehouse
+        self.storage_location = warehouse.storage_location
+        self.fba_location, = Location.create([{
+            'name': 'Amazon Inbound',
+            'type': 'storage',
+            'parent': warehouse.id,
+        }])
+
+        address, = Address.create([{
+            'party': self.party.id,
+            'name': 'ABC',
+            'street': '247 High Street',
+            'zip': '32801',
+            'city': 'Orlando',
+            'country': self.country1.id,
+            'subdivision': self.subdivision1.id,
+        }])
+        Location.write([warehouse], {'address': address.id})
+
+        template, = Template.create([{
+            'name': 'Test Product',
+            'default_uom': self.uom.id,
+            'account_expense': self.get_account_by_kind('expense'),
+            'account_revenue': self.get_account_by_kind('revenue'),
+            'products': [('create', [{
+                'code': code,
+                'list_price': Decimal('10.0'),
+                'cost_price': Decimal('8.0'),
+            } for code in ('SKU1', 'code2')])]
+        }])
+        products = dict(
+            (product.code, product) for product in template.products
+        )
+        self.product1, self.product2 = products['SKU1'], products['code2']
+
+        # The first product is sent with its code, the second with the FBA
+        # code of its listing
+        Listing.create([{
+            'channel': self.sale_channel.id,
+            'product': self.product1.id,
+            'product_identifier': 'SKU1',
+            'asin': 'B00F5O69LA',
+        }, {
+            'channel': self.sale_channel.id,
+            'product': self.product2.id,
+            'product_identifier': 'code2',
+            'fba_code': 'FBA2',
+            'asin': 'B00F5O69LB',
+        }])
+
+        lost_found, = Location.search([('type', '=', 'lost_found')])
+        moves = Move.create([{
+            'product': product.id,
+            'uom': self.uom.id,
+            'quantity': 10,
+            'from_location': lost_found.id,
+            'to_location': self.storage_location.id,
+            'company': self.company.id,
+        } for product in (self.product1, self.product2)])
+        Move.do(moves)
+
+    def create_inbound_shipment(self, shipment_id, moves):
+        """
+        Create an internal shipment to the FBA warehouse for the inbound
+        shipment on amazon
+
+        :param shipment_id: Shipment id on amazon
+        :param moves: List of (product, quantity, amazon sku)
+        """
+        Shipment = POOL.get('stock.shipment.internal')
+
+        shipment, = Shipment.create([{
+            'from_location': self.storage_location.id,
+            'to_location': self.fba_location.id,
+            'mws_inbound_shipment_id': shipment_id,
+            'moves': [('create', [{
+                'product': product.id,
+                'uom': self.uom.id,
+                'quantity': quantity,
+                'from_location': self.storage_location.id,
+                'to_location': self.fba_location.id,
+                'amazon_sku': sku,
+                'company': self.company.id,
+            } for product, quantity, sku in moves])],
+        }])
+        return shipment
+
+    def test_0010_sync_inbound_shipments(self):
+        """
+        Tests that the quantities received by amazon are saved on the moves
+        and closed shipments are done
+        """
+        Shipment = POOL.get('stock.shipment.internal')
+        SaleChannel = POOL.get('sale.channel')
+
+        statuses = {'SHIP1': 'WORKING'}
+
+        def iter_amazon_inbound_shipments(mws_connection_api, **kwargs):
+            return [
+                Data(ShipmentId=shipment_id, ShipmentStatus=status)
+                for shipment_id, status in statuses.iteritems()
+            ]
+
+        def iter_amazon_inbound_shipment_items(mws_connection_api, **kwargs):
+            return [
+                Data(ShipmentId='SHIP1', SellerSKU='SKU1',
+                     QuantityReceived='3'),
+                Data(ShipmentId='SHIP1', SellerSKU='FBA2',
+                     QuantityReceived='2'),
+                # Shipment which is not in tryton
+                Data(ShipmentId='SHIP2', SellerSKU='SKU1',
+                     QuantityReceived='7'),
+            ]
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                self.setup_inbound_defaults()
+
+                # The move of the second product was created before the
+                # SKU was saved on moves
+                shipment = self.create_inbound_shipment('SHIP1', [
+                    (self.product1, 5, 'SKU1'),
+                    (self.product2, 4, None),
+                ])
+
+                original_shipments = SaleChannel.iter_amazon_inbound_shipments
+                original_items = \
+                    SaleChannel.iter_amazon_inbound_shipment_items
+                original_api = SaleChannel.get_mws_boto_connection_api.im_func
+                SaleChannel.iter_amazon_inbound_shipments = staticmethod(
+                    iter_amazon_inbound_shipments
+                )
+                SaleChannel.iter_amazon_inbound_shipment_items = \
+                    staticmethod(iter_amazon_inbound_shipment_items)
+                SaleChannel.get_mws_boto_connection_api = lambda self: None
+                try:
+                    self.sale_channel.sync_amazon_inbound_shipments()
+
+                    shipment = Shipment(shipment.id)
+                    self.assertEqual(shipment.state, 'draft')
+                    self.assertEqual(dict(
+                        (move.product, move.amazon_quantity_received)
+                        for move in shipment.moves
+                    ), {self.product1: 3, self.product2: 2})
+                    self.assertIsNotNone(SaleChannel(
+                        self.sale_channel.id
+                    ).last_amazon_inbound_shipment_sync_time)
+
+                    statuses['SHIP1'] = 'CLOSED'
+                    self.sale_channel.sync_amazon_inbound_shipments()
+                    self.assertEqual(Shipment(shipment.id).state, 'done')
+                finally:
+                    SaleChannel.iter_amazon_inbound_shipments = staticmethod(
+                        original_shipments
+                    )
+                    SaleChannel.iter_amazon_inbound_shipment_items = \
+                        staticmethod(original_items)
+                    SaleChannel.get_mws_boto_connection_api = original_api
+
+    def test_0020_create_inbound_shipments(self):
+        """
+        Tests that the items are sent to amazon in chunks and an internal
+        shipment is created for every plan
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Request = POOL.get('inbound_shipment.request')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                self.setup_inbound_defaults()
+
+                connection = MWSConnection()
+                original_api = SaleChannel.get_mws_boto_connection_api.im_func
+                original_limit = Request._plan_items_limit
+                SaleChannel.get_mws_boto_connection_api = \
+                    lambda self: connection
+                Request._plan_items_limit = 1
+                try:
+                    shipments = Request.create_inbound_shipments(
+                        self.sale_channel, self.storage_location,
+                        self.fba_location,
+                        [(self.product1, 2), (self.product2, 3)]
+                    )
+
+                    # One plan request for every chunk of items
+                    self.assertEqual(
+                        sorted(connection.plan_requests),
+                        [['FBA2'], ['SKU1']]
+                    )
+                    self.assertEqual(
+                        sorted(connection.shipment_ids),
+                        ['SHIP-FBA2', 'SHIP-SKU1']
+                    )
+                    self.assertEqual(sorted(
+                        (
+                            shipment.mws_inbound_shipment_id,
+                            shipment.state,
+                            [(move.product, move.quantity, move.amazon_sku)
+                                for move in shipment.moves],
+                        ) for shipment in shipments
+                    ), [
+                        ('SHIP-FBA2', 'assigned', [(self.product2, 3, 'FBA2')]),
+                        ('SHIP-SKU1', 'assigned', [(self.product1, 2, 'SKU1')]),
+                    ])
+
+                    # Errors of amazon in the threads are raised
+                    connection.error = 'Invalid address'
+                    self.assertRaises(
+                        UserError, Request.create_inbound_shipments,
+                        self.sale_channel, self.storage_location,
+                        self.fba_location, [(self.product1, 1)]
+                    )
+                finally:
+                    SaleChannel.get_mws_boto_connection_api = original_api
+                    Request._plan_items_limit = original_limit
+
+    def test_0030_process_inbound_shipment_requests(self):
+        """
+        Tests that pending requests are sent to amazon by the cron and
+        failed requests keep the error
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Request = POOL.get('inbound_shipment.request')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                self.setup_inbound_defaults()
+
+                request1, request2 = Request.create([{
+                    'channel': self.sale_channel.id,
+                    'from_location': self.storage_location.id,
+                    'to_location': self.fba_location.id,
+                    'lines': [('create', [{
+                        'product': product.id,
+                        'quantity': 2,
+                    } for product in products])],
+                } for products in [
+                    [self.product1], [self.product1, self.product2]
+                ]])
+
+                connection = MWSConnection(error='Invalid address')
+                original_api = SaleChannel.get_mws_boto_connection_api.im_func
+                SaleChannel.get_mws_boto_connection_api = \
+                    lambda self: connection
+                try:
+                    Request.process_using_cron()
+                    for request in Request.browse([request1, request2]):
+                        self.assertEqual(request.state, 'failed')
+                        self.assertIn('Invalid address', request.error)
+                        self.assertEqual(request.shipments, ())
+
+                    # Failed requests are not sent again
+                    Request.write([request2], {'state': 'pending'})
+                    connection.error = None
+                    Request.process_using_cron()
+
+                    self.assertEqual(Request(request1.id).state, 'failed')
+                    request2 = Request(request2.id)
+                    self.assertEqual(request2.state, 'done')
+                    self.assertEqual(sorted(
+                        shipment.mws_inbound_shipment_id
+                        for shipment in request2.shipments
+                    ), ['SHIP-FBA2', 'SHIP-SKU1'])
+                finally:
+                    SaleChannel.get_mws_boto_connection_api = original_api
+
+    def test_0040_create_inbound_shipment_wizard(self):
+        """
+        Tests that the wizard creates the shipments right away for small
+        requests and leaves large requests to the cron
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Request = POOL.get('inbound_shipment.request')
+        Products = POOL.get('inbound_shipment.products')
+        InboundShipmentCreate = POOL.get(
+            'inbound_shipment.create', type='wizard'
+        )
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                self.setup_inbound_defaults()
+
+                def create_wizard(products):
+                    session_id, _, _ = InboundShipmentCreate.create()
+                    wizard = InboundShipmentCreate(session_id)
+                    wizard.start.from_location = self.storage_location
+                    wizard.start.to_location = self.fba_location
+                    wizard.start.products = [
+                        Products(product=product, quantity=2)
+                        for product in products
+                    ]
+                    return wizard
+
+                connection = MWSConnection()
+                original_api = SaleChannel.get_mws_boto_connection_api.im_func
+                original_limit = Request._plan_items_limit
+                SaleChannel.get_mws_boto_connection_api = \
+                    lambda self: connection
+                Request._plan_items_limit = 1
+                try:
+                    wizard = create_wizard([self.product1])
+                    self.assertEqual(
+                        wizard.transition_create_(), 'open_shipments'
+                    )
+                    shipment, = wizard.shipments
+                    self.assertEqual(
+                        shipment.mws_inbound_shipment_id, 'SHIP-SKU1'
+                    )
+                    self.assertEqual(Request.search([], count=True), 0)
+
+                    # Too many products, a request is left for the cron
+                    wizard = create_wizard([self.product1, self.product2])
+                    self.assertEqual(
+                        wizard.transition_create_(), 'open_request'
+                    )
+                    self.assertEqual(wizard.request.state, 'pending')
+                    self.assertEqual(
+                        wizard.request.channel, self.sale_channel
+                    )
+                    self.assertEqual(sorted(
+                        (line.product.code, line.quantity)
+                        for line in wizard.request.lines
+                    ), [('SKU1', 2), ('code2', 2)])
+                    self.assertEqual(connection.plan_requests, [['SKU1']])
+                finally:
+                    SaleChannel.get_mws_boto_connection_api = original_api
+                    Request._plan_items_limit = original_limit
+
+    def test_0050_done_inbound_shipments(self):
+        """
+        Tests that the statuses of the inbound shipments done together are
+        read from amazon at once and only closed shipments can be done
+        """
+        Shipment = POOL.get('stock.shipment.internal')
+        SaleChannel = POOL.get('sale.channel')
+
+        statuses = {'SHIP1': 'CLOSED', 'SHIP2': 'WORKING'}
+        requests = []
+
+        def iter_amazon_inbound_shipments(mws_connection_api, **kwargs):
+            requests.append(sorted(kwargs['ShipmentIdList']))
+            return [
+                Data(ShipmentId=shipment_id, ShipmentStatus=statuses[
+                    shipment_id
+                ]) for shipment_id in kwargs['ShipmentIdList']
+            ]
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(company=self.company.id):
+                self.setup_inbound_defaults()
+
+                # The last shipment is not sent to amazon
+                shipments = [
+                    self.create_inbound_shipment(
+                        shipment_id, [(self.product1, 1, 'SKU1')]
+                    ) for shipment_id in ('SHIP1', 'SHIP2', None)
+                ]
+                Shipment.wait(shipments)
+                Shipment.assign(shipments)
+
+                original_shipments = SaleChannel.iter_amazon_inbound_shipments
+                original_api = SaleChannel.get_mws_boto_connection_api.im_func
+                SaleChannel.iter_amazon_inbound_shipments = staticmethod(
+                    iter_amazon_inbound_shipments
+                )
+                SaleChannel.get_mws_boto_connection_api = lambda self: None
+                try:
+                    self.assertRaises(UserError, Shipment.done, shipments)
+                    self.assertEqual(requests, [['SHIP1', 'SHIP2']])
+                    self.assertEqual(
+                        [s.state for s in Shipment.browse(shipments)],
+                        ['assigned', 'assigned', 'assigned']
+                    )
+
+                    statuses['SHIP2'] = 'CLOSED'
+                    Shipment.done(shipments)
+                    self.assertEqual(len(requests), 2)
+                    self.assertEqual(
+                        [s.state for s in Shipment.browse(shipments)],
+                        ['done', 'done', 'done']
+                    )
+                finally:
+                    SaleChannel.iter_amazon_inbound_shipments = staticmethod(
+                        original_shipments
+                    )
+                    SaleChannel.get_mws_boto_connection_api = original_api
+
+    def test_0060_fba_warehouse_channels_cache(self):
+        """
+        Tests that the map of FBA warehouses to channels is not served from
+        the cache once the channels change
+        """
+        SaleChannel = POOL.get('sale.channel')
+        Location = POOL.get('stock.location')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            warehouse = self.sale_channel.fba_warehouse
+            location, = Location.create([{
+                'name': 'Amazon Inbound',
+                'type': 'storage',
+                'parent': warehouse.id,
+            }])
+
+            self.assertEqual(
+                SaleChannel.get_fba_warehouse_channels(),
+                {warehouse.id: self.sale_channel.id}
+            )
+            self.assertEqual(
+                Location(location.id).fba_channel, self.sale_channel
+            )
+
+            SaleChannel.write([self.sale_channel], {'fba_warehouse': None})
+            self.assertEqual(SaleChannel.get_fba_warehouse_channels(), {})
+            self.assertIsNone(Location(location.id).fba_channel)
+
+            SaleChannel.write([self.sale_channel], {
+                'fba_warehouse': warehouse.id,
+            })
+            self.assertEqual(
+                SaleChannel.get_fba_warehouse_channels(),
+                {warehouse.id: self.sale_channel.id}
+            )
+
+            SaleChannel.delete([self.sale_channel])
+            self.assertEqual(SaleChannel.get_fba_warehouse_channels(), {})
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestShipment)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())